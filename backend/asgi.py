@@ -0,0 +1,345 @@
+"""ASGI entry point serving the API with async handlers.
+
+The hot read endpoints (categories, question listings, search, quizzes and
+configs) are implemented here on top of SQLAlchemy's async engine and produce
+the same JSON bodies as ``views.py`` in production (non debug) mode. Every
+other route, writes included, is passed to the Flask application mounted
+below them, so both modes serve the same API and share the process caches.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+The async engine connects to ``ASYNC_DATABASE_URL``, by default the
+``DB_*`` database through asyncpg.
+"""
+import functools
+import json
+import math
+import os
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.sql import func
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from category_cache import category_cache
+from db_pool import engine_options
+from flaskr import create_app
+from models import Category, Question, database_path
+from profiling import profiler
+from question_index import question_index
+from rate_limit import SHED_RETRY_AFTER, forwarded_client, limiter
+import question_counts
+import search
+import serialization
+import streaming
+import views
+
+# reload the shared caches this many seconds before they expire, so the sync
+# loaders of the Flask side are never triggered from the event loop
+RELOAD_MARGIN = 1
+
+
+class JSONResponse(Response):
+    """JSON encoded exactly like jsonify outside debug mode: compact, sorted
+    keys and non-ASCII characters escaped"""
+
+    media_type = "application/json"
+
+    def render(self, content):
+        return json.dumps(content, sort_keys=True, separators=(",", ":")).encode() + b"\n"
+
+
+class QuestionsResponse(Response):
+    """Question listing, see serialization.render"""
+
+    media_type = "application/json"
+
+    def __init__(self, body, questions, **kwargs):
+        super().__init__(serialization.render(body, questions), **kwargs)
+
+
+def not_found():
+    return JSONResponse({"success": False, "error": 404, "message": "Not found"},
+                        status_code=404)
+
+
+def unprocessable():
+    return JSONResponse({"success": False, "error": 422, "message": "unprocessable"},
+                        status_code=422)
+
+
+def admitted(handler):
+    """Same admission control as the Flask routes, see rate_limit.Limiter.
+    Requests are shed right away, waiting for a slot would block the loop."""
+
+    @functools.wraps(handler)
+    async def wrapper(request):
+        client = forwarded_client(request.client.host if request.client else None,
+                                  request.headers.get("x-forwarded-for"),
+                                  limiter.trusted_proxies)
+        wait = limiter.check_rate(handler.__name__, client)
+        if wait is not None:
+            return JSONResponse(
+                {"success": False, "error": 429, "message": "too many requests"},
+                status_code=429, headers={"Retry-After": str(math.ceil(wait))})
+        if not limiter.acquire():
+            return JSONResponse(
+                {"success": False, "error": 503, "message": "service unavailable"},
+                status_code=503, headers={"Retry-After": str(SHED_RETRY_AFTER)})
+        try:
+            return await handler(request)
+        finally:
+            limiter.release()
+
+    return wrapper
+
+
+def profiled(handler):
+    """Slow requests and statements recorded like for the Flask routes, see
+    profiling.Profiler. Disabled, the handler is returned as is."""
+    if not profiler.enabled:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(request):
+        state = profiler.begin(handler.__name__, asynchronous=True)
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status_code
+            return response
+        finally:
+            query = request.url.query
+            profiler.end(state, request.method,
+                         f"{request.url.path}?{query}" if query else request.url.path,
+                         handler.__name__, status)
+
+    return wrapper
+
+
+def int_arg(request, name, default):
+    """Query argument converted to int, ``default`` when missing or invalid"""
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def wants_ndjson(request):
+    """Same rules as streaming.wants_ndjson"""
+    if request.query_params.get("stream", "").lower() in ("1", "true"):
+        return True
+    accept = request.headers.get("accept", "")
+    return streaming.NDJSON in accept and "application/json" not in accept
+
+
+def ndjson_response(session_factory, statement):
+    async def generate():
+        async with session_factory() as session:
+            result = await session.stream(statement)
+            async for row in result:
+                yield serialization.dumps(row._asdict()) + b"\n"
+
+    return StreamingResponse(generate(), media_type=streaming.NDJSON)
+
+
+def async_database_url():
+    return os.environ.get("ASYNC_DATABASE_URL",
+                          database_path.replace("postgresql://", "postgresql+asyncpg://", 1))
+
+
+def create_asgi_app(flask_app=None, database_url=None):
+    """Build the ASGI application around ``flask_app``, by default the one
+    returned by ``create_app()``"""
+    flask_app = flask_app or create_app()
+    database_url = database_url or async_database_url()
+    engine = create_async_engine(database_url, **engine_options(database_url))
+
+    def session_factory():
+        return AsyncSession(engine, expire_on_commit=False)
+
+    async def categories(session):
+        categories = category_cache.current(RELOAD_MARGIN)
+        if categories is None:
+            rows = await session.execute(
+                select(Category.id, Category.type).order_by(Category.id))
+            categories = category_cache.load(rows.all())
+        return categories
+
+    async def get_categories(request):
+        async with session_factory() as session:
+            body = {"categories": await categories(session)}
+        etag = f'"{category_cache.etag}"'
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(body, headers={
+            "ETag": etag,
+            "Last-Modified": category_cache.last_modified.strftime(
+                "%a, %d %b %Y %H:%M:%S GMT"),
+        })
+
+    async def get_questions(request):
+        page = max(int_arg(request, "page", 1), 1)
+        after_id = int_arg(request, "after_id", None)
+        statement = select(*streaming.QUESTION_COLUMNS).order_by(Question.id)
+        if after_id is None:
+            statement = statement.offset((page - 1) * views.QUESTIONS_PER_PAGE)
+        else:
+            statement = statement.where(Question.id > after_id)
+        async with session_factory() as session:
+            questions = (await session.execute(
+                statement.limit(views.QUESTIONS_PER_PAGE))).all()
+            total_questions = await session.scalar(question_counts.total_statement())
+            body = {
+                "total_questions": total_questions,
+                "categories": await categories(session),
+                "currentCategory": "unused",
+            }
+        if after_id is not None:
+            body["next_after_id"] = (
+                questions[-1].id if len(questions) == views.QUESTIONS_PER_PAGE else None
+            )
+        return QuestionsResponse(body, questions)
+
+    async def get_questions_by_category(request):
+        category_id = request.path_params["category_id"]
+        async with session_factory() as session:
+            current_category = (await categories(session)).get(str(category_id))
+            if current_category is None:
+                return not_found()
+            statement = select(*streaming.QUESTION_COLUMNS).where(
+                Question.category == category_id).order_by(Question.id)
+            if wants_ndjson(request):
+                return ndjson_response(session_factory, statement)
+            questions = (await session.execute(statement)).all()
+            total_questions = await session.scalar(
+                question_counts.total_statement(category_id))
+        return QuestionsResponse({
+            "total_questions": total_questions,
+            "currentCategory": current_category,
+        }, questions)
+
+    async def search_questions(request):
+        body = await request.json()
+        condition, order_by = search.search_criteria(
+            body["searchTerm"], engine.dialect.name)
+        if wants_ndjson(request):
+            return ndjson_response(session_factory, select(
+                *streaming.QUESTION_COLUMNS).where(condition).order_by(*order_by))
+        page = search.page_number(body.get("page", 1))
+        if page is None:
+            return unprocessable()
+        async with session_factory() as session:
+            questions = (await session.execute(
+                select(*streaming.QUESTION_COLUMNS).where(condition).order_by(*order_by)
+                .offset((page - 1) * views.QUESTIONS_PER_PAGE)
+                .limit(views.QUESTIONS_PER_PAGE))).all()
+            total_questions = await session.scalar(
+                select(func.count(Question.id)).where(condition))
+        return QuestionsResponse({
+            "total_questions": total_questions,
+            "currentCategory": "do not know what to return",
+        }, questions)
+
+    async def sample(session, method, *args):
+        """question_index.sample or sample_many, with the index loaded here
+        when missing, also when invalidated by another thread meanwhile"""
+        while True:
+            if question_index.expired(RELOAD_MARGIN):
+                rows = await session.execute(
+                    select(Question.id, Question.category, Question.difficulty))
+                question_index.load(rows.all())
+            try:
+                return getattr(question_index, method)(*args, load=False)
+            except LookupError:
+                continue
+
+    async def random_questions(previous_questions, category_id, count):
+        """Same selection as views.get_random_questions"""
+        excluded = set(previous_questions)
+        picked = []
+        async with session_factory() as session:
+            while len(picked) < count:
+                question_ids = await sample(
+                    session, "sample_many", category_id, count - len(picked), excluded)
+                if not question_ids:
+                    break
+                rows = {row.id: row for row in await session.execute(
+                    select(*streaming.QUESTION_COLUMNS).where(Question.id.in_(question_ids)))}
+                for question_id in question_ids:
+                    if question_id in rows:
+                        picked.append(rows[question_id])
+                    else:
+                        question_index.remove(question_id)
+                excluded.update(question_ids)
+        return picked
+
+    async def get_quizzes(request):
+        body = await request.json()
+        previous_questions = body["previous_questions"]
+        category_id = body["quiz_category"]["id"]
+        count = body.get("count")
+        difficulty = None
+        if "adaptive" in body:
+            difficulty = views.adaptive_difficulty(body["adaptive"])
+            if difficulty is None or count is not None:
+                return unprocessable()
+        if count is not None:
+            if type(count) is not int or count < 1:
+                return unprocessable()
+            count = min(count, views.QUESTIONS_PER_PLAY - len(previous_questions))
+            return QuestionsResponse({}, await random_questions(
+                previous_questions, category_id, count))
+        question = None
+        if len(previous_questions) < views.QUESTIONS_PER_PLAY:
+            async with session_factory() as session:
+                excluded = set(previous_questions)
+                while True:
+                    question_id = await sample(
+                        session, "sample", category_id, excluded, difficulty)
+                    if question_id is None:
+                        break
+                    question = await session.get(Question, question_id)
+                    if question is not None:
+                        break
+                    # deleted by another process since the index was loaded
+                    question_index.remove(question_id)
+                    excluded.add(question_id)
+        return JSONResponse({"question": question.format() if question else None})
+
+    async def get_configs(request):
+        return JSONResponse({"configs": {"questions_per_play": views.QUESTIONS_PER_PLAY}})
+
+    async def dispose():
+        await engine.dispose()
+
+    return Starlette(
+        routes=[
+            Route("/categories", admitted(profiled(get_categories)), methods=["GET"]),
+            Route("/questions", admitted(profiled(get_questions)), methods=["GET"]),
+            Route("/categories/{category_id:int}/questions",
+                  admitted(profiled(get_questions_by_category)), methods=["GET"]),
+            Route("/questions/search", admitted(profiled(search_questions)),
+                  methods=["POST"]),
+            Route("/quizzes", admitted(profiled(get_quizzes)), methods=["POST"]),
+            Route("/configs", profiled(get_configs), methods=["GET"]),
+            # everything else is served by the Flask application
+            Mount("/", app=WSGIMiddleware(flask_app)),
+        ],
+        middleware=[
+            Middleware(CORSMiddleware, allow_origins=["*"],
+                       allow_methods=["GET", "PUT", "POST", "PATCH", "DELETE", "OPTIONS"],
+                       allow_headers=["Content-Type", "Authorization", "true"],
+                       max_age=flask_app.config["CORS_MAX_AGE"]),
+            # gzip only; responses of the Flask routes arrive already encoded
+            Middleware(GZipMiddleware, minimum_size=flask_app.config["COMPRESS_MIN_SIZE"],
+                       compresslevel=flask_app.config["COMPRESS_LEVEL"]),
+        ],
+        on_shutdown=[dispose],
+    )
@@ -0,0 +1,100 @@
+"""Load test a running server: requests/sec and latency percentiles.
+
+Start both serving modes on the same database, then compare them:
+
+    flask run --port 5000            # or any WSGI server
+    uvicorn --factory asgi:create_asgi_app --port 8000
+    python benchmarks/loadtest.py --target wsgi=http://localhost:5000 --target asgi=http://localhost:8000
+
+Only the standard library is used, every worker thread keeps one request in
+flight at a time.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+
+CATEGORIES = 6
+
+
+def questions_request(base_url):
+    return urllib.request.Request(f"{base_url}/questions?page={random.randint(1, 5)}")
+
+
+def quizzes_request(base_url):
+    body = {"previous_questions": [], "quiz_category": {"type": "",
+                                                        "id": random.randint(0, CATEGORIES)}}
+    return urllib.request.Request(f"{base_url}/quizzes", data=json.dumps(body).encode(),
+                                  headers={"Content-Type": "application/json"})
+
+
+SCENARIOS = {"questions": questions_request, "quizzes": quizzes_request}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run(base_url, make_request, concurrency, duration):
+    """Hit the server from ``concurrency`` threads for ``duration`` seconds"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        nonlocal errors
+        local, failed = [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(make_request(base_url)) as response:
+                    response.read()
+                local.append(time.perf_counter() - started)
+            except OSError:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", action="append", required=True,
+                        help="name=base URL of a running server, repeatable")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="endpoints to hit, repeatable (default all)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{'target':>10} {'scenario':>10} {'rps':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for target in args.target:
+        name, base_url = target.split("=", 1)
+        for scenario in args.scenario or sorted(SCENARIOS):
+            result = run(base_url.rstrip("/"), SCENARIOS[scenario],
+                         args.concurrency, args.duration)
+            print(f"{name:>10} {scenario:>10} {result['rps']:>9} {result['p50_ms']!s:>8} "
+                  f"{result['p99_ms']!s:>8} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Seed a scratch database with generated questions for benchmarks"""
+import glob
+import os
+import random
+import re
+
+from sqlalchemy import text
+
+from models import Category, Question, db
+import question_counts
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "migrations")
+
+SEED_BATCH = 10000
+
+WORDS = (
+    "river mountain painter novel planet element battle king queen ocean "
+    "desert island composer film actor goal team league city capital empire "
+    "theory molecule organ artist museum poem author treaty revolution bridge "
+    "temple volcano forest glacier comet orbit symphony opera stadium trophy"
+).split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(size, categories=6):
+    """Replace the content of the database with ``size`` questions spread
+    over ``categories`` categories"""
+    rng = random.Random(size)
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Category.__table__.insert(), [
+        {"type": f"category {i}"} for i in range(1, categories + 1)])
+    for start in range(0, size, SEED_BATCH):
+        db.session.execute(Question.__table__.insert(), [
+            {
+                "question": sentence(rng, 8) + "?",
+                "answer": sentence(rng, 2),
+                "category": i % categories + 1,
+                "difficulty": i % 5 + 1,
+            }
+            for i in range(start, min(start + SEED_BATCH, size))
+        ])
+    question_counts.rebuild()
+    db.session.commit()
+    if db.engine.dialect.name == "postgresql":
+        apply_migrations()
+
+
+# what a statement separator must be looked for outside of: line comments,
+# string literals, dollar-quoted bodies (matched up to the same tag) and ';'
+SQL_TOKENS = re.compile(r"--[^\n]*|'(?:[^']|'')*'|(\$\w*\$).*?\1|;", re.DOTALL)
+
+
+def split_statements(sql):
+    """The statements of an SQL script, as psql would send them one by one"""
+    statements = []
+    start = 0
+    for match in SQL_TOKENS.finditer(sql):
+        if match.group() == ";":
+            statements.append(sql[start:match.start()])
+            start = match.end()
+    statements.append(sql[start:])
+    # drop what is only comments and blank lines
+    return [statement.strip() for statement in statements
+            if SQL_TOKENS.sub("", statement).strip()]
+
+
+def apply_migrations():
+    """Run migrations/*.sql, which add what create_all() does not create,
+    like the full-text search index"""
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block, which
+    # a script sent at once implicitly is: statements go one at a time
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS, "*.sql"))):
+            with open(path) as file:
+                for statement in split_statements(file.read()):
+                    connection.execute(text(statement))
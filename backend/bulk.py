@@ -0,0 +1,208 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from sqlalchemy import case
+
+from models import Question, db
+import question_counts
+
+# rows sent to the database per multi-row INSERT
+BULK_BATCH_SIZE = 1000
+
+# errors listed in the import report, the rest is only counted
+MAX_REPORTED_ERRORS = 100
+
+CSV = "text/csv"
+
+# questions deleted or updated by one batch request
+MAX_BATCH_SIZE = 1000
+
+# columns a batch update may change
+UPDATABLE = ("question", "answer", "difficulty", "category")
+
+
+def read_rows(stream, content_type):
+    """Parse an NDJSON or CSV body lazily.
+    Yields (line number, row, error message) tuples."""
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if content_type == CSV:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row, None
+    else:
+        for line_num, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_num, None, "invalid JSON"
+                continue
+            if isinstance(row, dict):
+                yield line_num, row, None
+            else:
+                yield line_num, None, "expected a JSON object"
+
+
+def validate(row, categories):
+    """Return the columns of a question row, raise ValueError if invalid.
+    ``categories`` is the catalogue of existing categories."""
+    question = row.get("question")
+    answer = row.get("answer")
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("question is required")
+    if not isinstance(answer, str) or not answer.strip():
+        raise ValueError("answer is required")
+    try:
+        difficulty = int(row.get("difficulty"))
+        category = int(row.get("category"))
+    except (TypeError, ValueError):
+        raise ValueError("difficulty and category must be integers")
+    if not 1 <= difficulty <= 5:
+        raise ValueError("difficulty must be between 1 and 5")
+    if str(category) not in categories:
+        raise ValueError(f"category {category} does not exist")
+    return {"question": question, "answer": answer,
+            "difficulty": difficulty, "category": category}
+
+
+def body_field(body, name):
+    """Value of ``name`` in a JSON request body, raise ValueError if the body
+    is not an object"""
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    return body.get(name)
+
+
+def validate_ids(ids):
+    """Return the question ids of a batch, raise ValueError if invalid"""
+    if not isinstance(ids, list) or not 1 <= len(ids) <= MAX_BATCH_SIZE:
+        raise ValueError(f"ids must be a list of 1 to {MAX_BATCH_SIZE} question ids")
+    # bool is an int, not an id
+    if any(type(id) is not int for id in ids):
+        raise ValueError("ids must be integers")
+    return list(dict.fromkeys(ids))
+
+
+def validate_changes(rows, categories):
+    """Return the changes of a batch update as {question id: {column: value}},
+    raise ValueError if invalid. ``categories`` is the catalogue of existing
+    categories."""
+    if not isinstance(rows, list):
+        raise ValueError("questions must be a list")
+    changes = {}
+    for row in rows:
+        if not isinstance(row, dict) or type(row.get("id")) is not int:
+            raise ValueError("every question needs an integer id")
+        columns = {name: value for name, value in row.items() if name != "id"}
+        if not columns or not set(columns) <= set(UPDATABLE):
+            raise ValueError(f"question {row['id']}: update some of {', '.join(UPDATABLE)}")
+        for name, value in columns.items():
+            if name in ("question", "answer"):
+                if not isinstance(value, str) or not value.strip():
+                    raise ValueError(f"question {row['id']}: {name} cannot be empty")
+                continue
+            try:
+                columns[name] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"question {row['id']}: {name} must be an integer")
+        if not 1 <= columns.get("difficulty", 1) <= 5:
+            raise ValueError(f"question {row['id']}: difficulty must be between 1 and 5")
+        if "category" in columns and str(columns["category"]) not in categories:
+            raise ValueError(f"question {row['id']}: category {columns['category']} does not exist")
+        changes.setdefault(row["id"], {}).update(columns)
+    validate_ids(list(changes))
+    return changes
+
+
+def _lock_rows(ids):
+    """(id, category, difficulty) of the existing questions among ``ids``,
+    locked until the end of the transaction"""
+    return db.session.query(Question.id, Question.category, Question.difficulty).filter(
+        Question.id.in_(ids)).order_by(Question.id).with_for_update().all()
+
+
+def delete_questions(ids):
+    """Delete the questions of ``ids`` with one statement, within the current
+    transaction, question counts included. Returns the (id, category,
+    difficulty) rows of the deleted questions."""
+    rows = _lock_rows(ids)
+    if rows:
+        db.session.execute(Question.__table__.delete().where(
+            Question.id.in_([row.id for row in rows])))
+        counts = Counter()
+        for row in rows:
+            counts[question_counts.key(row.category, row.difficulty)] -= 1
+        question_counts.apply(counts)
+    return rows
+
+
+def update_questions(changes):
+    """Apply ``changes`` (see validate_changes) with one UPDATE statement,
+    within the current transaction, question counts included. Returns the
+    {id, category, difficulty} of the updated questions, as (before, after)
+    pairs."""
+    rows = _lock_rows(list(changes))
+    if not rows:
+        return []
+    # each changed column is set to a CASE on the id, unlisted ids keep theirs
+    values = {}
+    for name in UPDATABLE:
+        whens = {row.id: changes[row.id][name] for row in rows if name in changes[row.id]}
+        if whens:
+            values[name] = case(whens, value=Question.id, else_=getattr(Question, name))
+    db.session.execute(Question.__table__.update().where(
+        Question.id.in_([row.id for row in rows])).values(values))
+    updates = []
+    counts = Counter()
+    for row in rows:
+        before = row._asdict()
+        moved = {name: changes[row.id][name] for name in ("category", "difficulty")
+                 if name in changes[row.id]}
+        after = dict(before, **moved)
+        updates.append((before, after))
+        counts[question_counts.key(before["category"], before["difficulty"])] -= 1
+        counts[question_counts.key(after["category"], after["difficulty"])] += 1
+    question_counts.apply(counts)
+    return updates
+
+
+def import_questions(stream, content_type, categories):
+    """Insert the valid rows of the body in batches, within the current
+    transaction, question counts included. Returns the number of inserted
+    rows, the ids of the categories they belong to, the first errors and the
+    error count."""
+    inserted = 0
+    touched_categories = set()
+    counts = Counter()
+    errors = []
+    error_count = 0
+    batch = []
+
+    def flush():
+        if batch:
+            db.session.execute(Question.__table__.insert(), batch)
+            batch.clear()
+
+    for line_num, row, error in read_rows(stream, content_type):
+        if error is None:
+            try:
+                row = validate(row, categories)
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line_num, "error": error})
+            continue
+        batch.append(row)
+        inserted += 1
+        touched_categories.add(row["category"])
+        counts[question_counts.key(row["category"], row["difficulty"])] += 1
+        if len(batch) >= BULK_BATCH_SIZE:
+            flush()
+    flush()
+    question_counts.apply(counts)
+    return inserted, touched_categories, errors, error_count
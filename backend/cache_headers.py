@@ -0,0 +1,43 @@
+import os
+
+from flask import current_app, request
+
+from routing import is_read_only
+
+
+class CacheHeaders:
+    """HTTP caching of the read endpoints, the views marked ``read_only``.
+
+    Successful GET responses get an ETag, a hash of the body unless the view
+    set one, and are answered with 304 Not Modified when the client already
+    holds them. ``Cache-Control`` lets clients reuse a response for
+    ``HTTP_CACHE_MAX_AGE`` seconds without asking; with 0 they revalidate
+    every time, which costs a round trip but no body.
+    """
+
+    def __init__(self):
+        self.max_age = 0
+
+    def init_app(self, app):
+        self.max_age = app.config.setdefault(
+            "HTTP_CACHE_MAX_AGE", int(os.environ.get("HTTP_CACHE_MAX_AGE", 0)))
+        app.after_request(self._add_headers)
+
+    def _add_headers(self, response):
+        view = current_app.view_functions.get(request.endpoint)
+        if request.method not in ("GET", "HEAD") or not is_read_only(view):
+            return response
+        # listings are served as JSON or NDJSON depending on Accept
+        response.vary.add("Accept")
+        if response.status_code != 200 or response.is_streamed:
+            return response
+        if self.max_age:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+        else:
+            response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
+
+
+cache_headers = CacheHeaders()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from models import Category, db
+
+# seconds the catalogue is kept before being reloaded, so categories created by
+# other processes show up
+CATEGORY_CACHE_TTL = int(os.environ.get("CATEGORY_CACHE_TTL", 60))
+
+# minimum seconds between reloads triggered by lookups of unknown ids
+MISS_RELOAD_INTERVAL = 1
+
+
+class CategoryCache:
+    """Process-local copy of the categories table.
+
+    Categories almost never change, so every endpoint reads them from here
+    instead of querying the database. ``etag`` and ``last_modified`` describe
+    the current content for conditional requests.
+    """
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._categories = None
+        self._loaded_at = 0
+        self.etag = None
+        self.last_modified = None
+
+    def expired(self, margin=0):
+        """Whether the catalogue must be (re)loaded, or will be within
+        ``margin`` seconds"""
+        return (self._categories is None
+                or time.monotonic() - self._loaded_at > self.ttl - margin)
+
+    def load(self, rows):
+        """Replace the catalogue with (category id, type) rows, returns it"""
+        with self._lock:
+            return self._replace(rows)
+
+    def _replace(self, rows):
+        categories = {str(id): type for id, type in rows}
+        etag = hashlib.sha1(
+            json.dumps(categories, sort_keys=True).encode()).hexdigest()
+        if etag != self.etag:
+            self.etag = etag
+            self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self._categories = categories
+        self._loaded_at = time.monotonic()
+        return categories
+
+    def _load(self):
+        self._replace(db.session.query(Category.id, Category.type).order_by(Category.id))
+
+    def _ensure_loaded(self):
+        if self.expired():
+            self._load()
+
+    def all(self):
+        """Categories as id: type pairs, the format the frontend expects"""
+        with self._lock:
+            self._ensure_loaded()
+            return self._categories
+
+    def current(self, margin=0):
+        """Categories as loaded, None when they must be (re)loaded or will be
+        within ``margin`` seconds. Never queries the database, for the async
+        handlers which load them with ``load``."""
+        with self._lock:
+            return None if self.expired(margin) else self._categories
+
+    def get(self, category_id):
+        """Type of the category, None if it does not exist"""
+        key = str(category_id)
+        with self._lock:
+            self._ensure_loaded()
+            # possibly created by another process since the last load
+            if (key not in self._categories
+                    and time.monotonic() - self._loaded_at > MISS_RELOAD_INTERVAL):
+                self._load()
+            return self._categories.get(key)
+
+    def invalidate(self):
+        """Drop the catalogue, it is reloaded on next use"""
+        with self._lock:
+            self._categories = None
+
+
+category_cache = CategoryCache()
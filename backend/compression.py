@@ -0,0 +1,69 @@
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional dependency, only gzip is offered without it
+    brotli = None
+
+# media types worth compressing
+COMPRESSIBLE = ("application/json", "text/csv", "text/plain")
+
+
+class Compression:
+    """Compresses JSON and text responses with brotli or gzip, whichever the
+    client accepts.
+
+    Configured from ``COMPRESS_ALGORITHMS`` (comma separated, by preference),
+    ``COMPRESS_MIN_SIZE`` (bytes, smaller bodies are sent as is),
+    ``COMPRESS_LEVEL`` (gzip, 1 to 9) and ``COMPRESS_BROTLI_QUALITY`` (0 to
+    11). Streamed responses are not compressed.
+    """
+
+    def __init__(self):
+        self.algorithms = []
+        self.min_size = 500
+        self.level = 6
+        self.brotli_quality = 4
+
+    def init_app(self, app):
+        algorithms = app.config.setdefault("COMPRESS_ALGORITHMS", [
+            name for name in os.environ.get("COMPRESS_ALGORITHMS", "br,gzip").split(",") if name])
+        self.algorithms = [name for name in algorithms if name != "br" or brotli is not None]
+        self.min_size = app.config.setdefault(
+            "COMPRESS_MIN_SIZE", int(os.environ.get("COMPRESS_MIN_SIZE", 500)))
+        self.level = app.config.setdefault(
+            "COMPRESS_LEVEL", int(os.environ.get("COMPRESS_LEVEL", 6)))
+        self.brotli_quality = app.config.setdefault(
+            "COMPRESS_BROTLI_QUALITY", int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4)))
+        app.after_request(self._compress)
+
+    def _compress(self, response):
+        if (not self.algorithms or response.status_code != 200
+                or response.is_streamed or response.direct_passthrough
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE):
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = request.accept_encodings.best_match(self.algorithms)
+        if encoding == "br":
+            data = brotli.compress(data, quality=self.brotli_quality)
+        elif encoding == "gzip":
+            data = gzip.compress(data, compresslevel=self.level, mtime=0)
+        else:
+            return response
+        response.set_data(data)
+        response.headers["Content-Encoding"] = encoding
+        # the encoded body differs byte for byte, only weakly the same
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compression = Compression()
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes")
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool keeping track of how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+
+def engine_options(database_path):
+    """Engine options for ``database_path`` read from the environment:
+
+    - DB_POOL_SIZE, DB_MAX_OVERFLOW: connections kept open and allowed on top
+    - DB_POOL_TIMEOUT: seconds to wait for a connection before failing
+    - DB_POOL_RECYCLE: seconds after which a connection is replaced
+    - DB_POOL_PRE_PING: test connections on checkout, survives database restarts
+    - DB_STATEMENT_TIMEOUT: milliseconds before a statement is cancelled, 0 for none
+    - DB_PGBOUNCER: connecting through PgBouncer in transaction pooling mode
+    """
+    if not str(database_path).startswith("postgresql"):
+        # SQLite and friends keep the pooling picked by Flask-SQLAlchemy
+        return {}
+    asyncpg = "+asyncpg" in str(database_path)
+    options = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": _env_flag("DB_POOL_PRE_PING", True),
+    }
+    if not asyncpg:
+        # async engines need their own asyncio aware pool
+        options["poolclass"] = TimedQueuePool
+    statement_timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT", 0))
+    if _env_flag("DB_PGBOUNCER", False):
+        # PgBouncer rejects the "options" startup parameter and shares server
+        # connections between clients, so no session state may be set here:
+        # configure statement_timeout on the database role instead.
+        # psycopg2 never prepares statements server side, async drivers must
+        # not either.
+        if asyncpg:
+            options["connect_args"] = {"statement_cache_size": 0,
+                                       "prepared_statement_cache_size": 0}
+    elif statement_timeout and asyncpg:
+        options["connect_args"] = {
+            "server_settings": {"statement_timeout": str(statement_timeout)}}
+    elif statement_timeout:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={statement_timeout}"}
+    return options
+
+
+def pool_stats(engine):
+    """Counters of the connection pool of ``engine``"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"status": pool.status()}
+    stats = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+    if isinstance(pool, TimedQueuePool):
+        stats.update({
+            "checkouts": pool.checkouts,
+            "timeouts": pool.timeouts,
+            "wait_time_total": round(pool.wait_time, 6),
+            "wait_time_max": round(pool.max_wait_time, 6),
+        })
+    return stats
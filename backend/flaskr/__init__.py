@@ -2,21 +2,83 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import views
+from werkzeug.utils import cached_property, import_string
 
-from models import setup_db, Question, Category
+from models import setup_db, database_path, Question, Category
 
 QUESTIONS_PER_PAGE = 10
 
 
+class LazyView:
+    """A view imported on its first request, so starting the app does not pay
+    for importing views and everything they use.
+
+    Only the attributes read by the wrappers are delegated, Flask reads others
+    such as ``methods`` when registering the rule and must not import it.
+    """
+
+    def __init__(self, import_name):
+        self.__module__, self.__name__ = import_name.rsplit(".", 1)
+        self.__qualname__ = self.__name__
+        self.import_name = import_name
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    @property
+    def read_only(self):
+        return getattr(self.view, "read_only", False)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+
+def lazy(name):
+    return LazyView(f"views.{name}")
+
+
+def retry_after_header(error):
+    """``Retry-After`` of a 429 or 503, only when the abort gave one"""
+    if getattr(error, "retry_after", None) is None:
+        return {}
+    return {"Retry-After": str(error.retry_after)}
+
+
 def create_app(test_config=None):
+    # imported here, importing flaskr stays cheap
+    from cache_headers import cache_headers
+    from compression import compression
+    from metrics import metrics
+    from profiling import profiler
+    from question_store import question_store
+    from rate_limit import limiter
+    from response_cache import response_cache
+    from routing import replicas
+    from write_behind import write_behind
+
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path))
+    replicas.init_app(app)
+    response_cache.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    limiter.init_app(app)
+    write_behind.init_app(app)
+    question_store.init_app(app)
+    # after_request hooks run in reverse order: ETags and 304s are computed
+    # on the plain body, then compressed, then measured by metrics
+    compression.init_app(app)
+    cache_headers.init_app(app)
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
+    # browsers cache preflight responses for this many seconds
+    app.config.setdefault("CORS_MAX_AGE", int(os.environ.get("CORS_MAX_AGE", 600)))
     cors = CORS(app, resources={r"/*": {"origins": "*"}})
 
     """
@@ -28,7 +90,7 @@ def create_app(test_config=None):
             "Access-Control-Allow-Headers", "Content-Type,Authorization,true"
         )
         response.headers.add(
-            "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS"
+            "Access-Control-Allow-Methods", "GET,PUT,POST,PATCH,DELETE,OPTIONS"
         )
         return response
 
@@ -38,9 +100,9 @@ def create_app(test_config=None):
     for all available categories.
     """
     app.add_url_rule(
-        "/categories", methods=["GET"], view_func=views.get_categories)
+        "/categories", methods=["GET"], view_func=lazy("get_categories"))
     app.add_url_rule(
-        "/categories", methods=["POST"], view_func=views.create_category)
+        "/categories", methods=["POST"], view_func=lazy("create_category"))
     """
     @TODO:
     Create an endpoint to handle GET requests for questions,
@@ -54,7 +116,8 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     """
     app.add_url_rule(
-        "/questions", methods=["GET"], view_func=views.get_questions)
+        "/questions", methods=["GET"],
+        view_func=response_cache.cached(lazy("get_questions"), "questions", "categories"))
 
     """
     @TODO:
@@ -64,7 +127,7 @@ def create_app(test_config=None):
     This removal will persist in the database and when you refresh the page.
     """
     app.add_url_rule("/questions/<int:question_id>",
-                     methods=["DELETE"], view_func=views.delete_question)
+                     methods=["DELETE"], view_func=lazy("delete_question"))
 
     """
     @TODO:
@@ -77,7 +140,15 @@ def create_app(test_config=None):
     of the questions list in the "List" tab.
     """
     app.add_url_rule(
-        "/questions", methods=["POST"], view_func=views.create_question)
+        "/questions", methods=["POST"], view_func=lazy("create_question"))
+    app.add_url_rule(
+        "/questions/bulk", methods=["POST"], view_func=lazy("import_questions"))
+    app.add_url_rule(
+        "/questions", methods=["DELETE"], view_func=lazy("delete_questions"))
+    app.add_url_rule(
+        "/questions", methods=["PATCH"], view_func=lazy("update_questions"))
+    app.add_url_rule(
+        "/questions/export", methods=["GET"], view_func=lazy("export_questions"))
 
     """
     @TODO:
@@ -90,7 +161,8 @@ def create_app(test_config=None):
     Try using the word "title" to start.
     """
     app.add_url_rule(
-        "/questions/search", methods=["POST"], view_func=views.search_questions)
+        "/questions/search", methods=["POST"],
+        view_func=response_cache.cached(lazy("search_questions"), "questions"))
 
     """
     @TODO:
@@ -101,7 +173,8 @@ def create_app(test_config=None):
     category to be shown.
     """
     app.add_url_rule(
-        "/categories/<int:category_id>/questions", methods=["GET"], view_func=views.get_questions_by_category)
+        "/categories/<int:category_id>/questions", methods=["GET"],
+        view_func=response_cache.cached(lazy("get_questions_by_category"), "category:{category_id}"))
 
     """
     @TODO:
@@ -114,10 +187,35 @@ def create_app(test_config=None):
     one question at a time is displayed, the user is allowed to answer
     and shown whether they were correct or not.
     """
-    app.add_url_rule("/quizzes", methods=["POST"], view_func=views.get_quizzes)
+    app.add_url_rule("/quizzes", methods=["POST"], view_func=lazy("get_quizzes"))
+    app.add_url_rule("/quizzes/sessions",
+                     methods=["POST"], view_func=lazy("create_quiz_session"))
+    app.add_url_rule("/quizzes/sessions/<token>/next",
+                     methods=["POST"], view_func=lazy("get_quiz_session_question"))
+
+    app.add_url_rule(
+        "/stats", methods=["GET"],
+        view_func=response_cache.cached(lazy("get_stats"), "questions"))
 
     app.add_url_rule("/configs",
-                     methods=["GET"], view_func=views.get_configs)
+                     methods=["GET"], view_func=lazy("get_configs"))
+
+    app.add_url_rule("/ops/cache",
+                     methods=["GET"], view_func=lazy("get_cache_stats"))
+    app.add_url_rule("/ops/pool",
+                     methods=["GET"], view_func=lazy("get_pool_stats"))
+    app.add_url_rule("/ops/limits",
+                     methods=["GET"], view_func=lazy("get_limit_stats"))
+    app.add_url_rule("/ops/writes",
+                     methods=["GET"], view_func=lazy("get_write_stats"))
+    app.add_url_rule("/ops/store",
+                     methods=["GET"], view_func=lazy("get_store_stats"))
+    app.add_url_rule("/metrics",
+                     methods=["GET"], view_func=lazy("get_metrics"))
+    app.add_url_rule("/debug/profiles",
+                     methods=["GET"], view_func=lazy("get_profiles"))
+    app.add_url_rule("/debug/profiles/<profile_id>",
+                     methods=["GET"], view_func=lazy("get_profile"))
 
     """
     @TODO:
@@ -125,6 +223,14 @@ def create_app(test_config=None):
     including 404 and 422.
     """
 
+    @app.errorhandler(401)
+    def unauthorized(error):
+        return jsonify({
+            "success": False,
+            "error": 401,
+            "message": "unauthorized"
+        }), 401
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -133,6 +239,14 @@ def create_app(test_config=None):
             "message": "Not found"
         }), 404
 
+    @app.errorhandler(415)
+    def unsupported_media_type(error):
+        return jsonify({
+            "success": False,
+            "error": 415,
+            "message": "unsupported media type"
+        }), 415
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -141,4 +255,20 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+        }), 429, retry_after_header(error)
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503, retry_after_header(error)
+
     return app
@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import db_pool
+from models import db
+from question_store import question_store
+from rate_limit import limiter
+from response_cache import response_cache
+from routing import replicas
+from write_behind import write_behind
+
+# upper bounds of the request duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RouteStats:
+    __slots__ = ("buckets", "count", "duration", "queries", "db_time", "response_bytes")
+
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.response_bytes = 0
+
+
+class Metrics:
+    """Per-route request metrics, exported in the Prometheus text format.
+
+    Configured from ``METRICS_SERVER_TIMING`` (add a ``Server-Timing`` header
+    with the request and database time) and ``METRICS_N_PLUS_ONE``: log a
+    warning when one request runs the same SQL statement at least this many
+    times, 0 to disable.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._statuses = Counter()
+        self.server_timing = False
+        self.n_plus_one = 0
+
+    def init_app(self, app):
+        self.server_timing = app.config.setdefault(
+            "METRICS_SERVER_TIMING",
+            os.environ.get("METRICS_SERVER_TIMING", "false").lower() in ("1", "true"))
+        self.n_plus_one = app.config.setdefault(
+            "METRICS_N_PLUS_ONE", int(os.environ.get("METRICS_N_PLUS_ONE", 0)))
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_db_time = 0.0
+        g.metrics_statements = Counter()
+
+    def _finish_request(self, response):
+        if "metrics_started" not in g:
+            return response
+        duration = time.perf_counter() - g.metrics_started
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        size = response.calculate_content_length() or 0
+        with self._lock:
+            stats = self._routes.setdefault((request.method, route), RouteStats())
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    stats.buckets[i] += 1
+            stats.count += 1
+            stats.duration += duration
+            stats.queries += g.metrics_queries
+            stats.db_time += g.metrics_db_time
+            stats.response_bytes += size
+            self._statuses[(request.method, route, response.status_code)] += 1
+        if self.server_timing:
+            response.headers.add(
+                "Server-Timing",
+                f'app;dur={duration * 1000:.1f}, '
+                f'db;dur={g.metrics_db_time * 1000:.1f};desc="{g.metrics_queries} queries"')
+        if self.n_plus_one:
+            for statement, count in g.metrics_statements.items():
+                if count >= self.n_plus_one:
+                    current_app.logger.warning(
+                        "possible N+1 on %s %s: %d x %s", request.method, route,
+                        count, " ".join(statement.split()))
+        return response
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            routes = sorted(self._routes.items())
+            statuses = sorted(self._statuses.items())
+        family("trivia_request_duration_seconds", "histogram", "Request duration per route.")
+        for (method, route), stats in routes:
+            labels = f'method="{method}",route="{route}"'
+            for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                lines.append(f'trivia_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'trivia_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+            lines.append(f"trivia_request_duration_seconds_sum{{{labels}}} {stats.duration:.6f}")
+            lines.append(f"trivia_request_duration_seconds_count{{{labels}}} {stats.count}")
+        family("trivia_requests_total", "counter", "Requests per route and status code.")
+        for (method, route, status), count in statuses:
+            lines.append(
+                f'trivia_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+        for name, attribute, help in (
+                ("trivia_db_queries_total", "queries", "SQL statements executed per route."),
+                ("trivia_db_time_seconds_total", "db_time", "Time spent in SQL statements per route."),
+                ("trivia_response_size_bytes_total", "response_bytes",
+                 "Bytes of response bodies per route, streamed bodies excluded.")):
+            family(name, "counter", help)
+            for (method, route), stats in routes:
+                lines.append(f'{name}{{method="{method}",route="{route}"}} {getattr(stats, attribute)}')
+
+        cache = response_cache.stats()
+        for key in ("hits", "misses", "evictions"):
+            family(f"trivia_response_cache_{key}_total", "counter", f"Response cache {key}.")
+            lines.append(f"trivia_response_cache_{key}_total {cache[key]}")
+        family("trivia_response_cache_entries", "gauge", "Responses held by the cache.")
+        lines.append(f"trivia_response_cache_entries {cache['size']}")
+
+        limits = limiter.stats()
+        for name, key in (("trivia_rate_limit_allowed_total", "allowed"),
+                          ("trivia_rate_limit_limited_total", "limited")):
+            family(name, "counter", f"Requests {key} by the rate limiter per endpoint.")
+            for endpoint, count in sorted(limits[key].items()):
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {count}')
+        family("trivia_requests_shed_total", "counter",
+               "Requests rejected because too many were in flight.")
+        lines.append(f"trivia_requests_shed_total {limits['shed']}")
+        family("trivia_requests_in_flight", "gauge", "Database bound requests in flight.")
+        lines.append(f"trivia_requests_in_flight {limits['in_flight']}")
+
+        writes = write_behind.stats()
+        for name, key, help in (
+                ("trivia_write_behind_flushes_total", "flushes", "Write-behind transactions committed."),
+                ("trivia_write_behind_questions_total", "flushed", "Questions committed by write-behind."),
+                ("trivia_write_behind_failed_total", "failed", "Questions write-behind failed to commit."),
+                ("trivia_write_behind_flush_seconds_total", "flush_seconds_total",
+                 "Time spent in write-behind transactions."),
+                ("trivia_write_behind_wait_seconds_total", "wait_seconds_total",
+                 "Time questions waited from queued to committed.")):
+            family(name, "counter", help)
+            lines.append(f"{name} {writes[key]}")
+        family("trivia_write_behind_queued", "gauge", "Questions waiting for write-behind.")
+        lines.append(f"trivia_write_behind_queued {writes['queued']}")
+
+        store = question_store.stats()
+        for name, key, kind, help in (
+                ("trivia_question_store_questions", "questions", "gauge", "Questions held in memory."),
+                ("trivia_question_store_bytes", "bytes", "gauge", "Size of the columns of the question store."),
+                ("trivia_question_store_resyncs_total", "resyncs", "counter",
+                 "Full reloads of the question store."),
+                ("trivia_question_store_notifications_total", "notifications", "counter",
+                 "Change notifications applied to the question store.")):
+            family(name, kind, help)
+            lines.append(f"{name} {store[key]}")
+
+        pools = [("primary", db.engine)] + [
+            (f"replica{i}", engine) for i, engine in enumerate(replicas.engines)]
+        for name, key, kind in (
+                ("trivia_db_pool_checked_out", "checked_out", "gauge"),
+                ("trivia_db_pool_overflow", "overflow", "gauge"),
+                ("trivia_db_pool_checkouts_total", "checkouts", "counter"),
+                ("trivia_db_pool_timeouts_total", "timeouts", "counter"),
+                ("trivia_db_pool_wait_seconds_total", "wait_time_total", "counter")):
+            family(name, kind, f"Connection pool {key.replace('_', ' ')}.")
+            for label, engine in pools:
+                value = db_pool.pool_stats(engine).get(key)
+                if value is not None:
+                    lines.append(f'{name}{{pool="{label}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# Engine events are registered once for every engine, the primary, replicas
+# and the ones of later create_app() calls alike. They only count statements
+# executed while handling a request.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["metrics_query_start"].pop()
+    if has_request_context() and "metrics_started" in g:
+        g.metrics_queries += 1
+        g.metrics_db_time += time.perf_counter() - started
+        g.metrics_statements[statement] += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("metrics_query_start")
+        if starts:
+            starts.pop()
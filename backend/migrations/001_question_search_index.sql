@@ -0,0 +1,9 @@
+--
+-- Full-text search index for POST /questions/search.
+-- The indexed expression must match search.SEARCH_DOCUMENT.
+--
+-- psql trivia < migrations/001_question_search_index.sql
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS questions_search_idx
+    ON public.questions USING gin (to_tsvector('english'::regconfig, ((COALESCE(question, ''::text) || ' '::text) || COALESCE(answer, ''::text))));
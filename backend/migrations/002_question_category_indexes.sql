@@ -0,0 +1,33 @@
+--
+-- Align questions.category with the model (integer referencing categories.id)
+-- and index the columns the endpoints filter on.
+--
+-- psql trivia < migrations/002_question_category_indexes.sql
+--
+
+DO $$
+BEGIN
+    -- databases created by db.create_all() from older models have a varchar column
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'questions' AND column_name = 'category') <> 'integer' THEN
+        ALTER TABLE public.questions ALTER COLUMN category TYPE integer USING category::integer;
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'public.questions'::regclass AND contype = 'f') THEN
+        -- same outcome as deleting the category with the constraint in place
+        UPDATE public.questions SET category = NULL
+            WHERE category NOT IN (SELECT id FROM public.categories);
+        ALTER TABLE ONLY public.questions
+            ADD CONSTRAINT category FOREIGN KEY (category) REFERENCES public.categories(id) ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END
+$$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS questions_category_id_idx
+    ON public.questions USING btree (category, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS questions_difficulty_idx
+    ON public.questions USING btree (difficulty);
+
+ANALYZE public.questions;
@@ -0,0 +1,52 @@
+--
+-- Question counts per category and difficulty, kept up to date by the
+-- application in the transaction of every write to questions, and by a
+-- trigger when a category is deleted or its id changes, which the foreign key
+-- of questions.category passes on to the questions without the application.
+-- 0 stands for a NULL category or difficulty.
+--
+-- psql trivia < migrations/003_question_counts.sql
+--
+
+CREATE TABLE IF NOT EXISTS public.question_counts (
+    category integer NOT NULL,
+    difficulty integer NOT NULL,
+    count integer NOT NULL,
+    PRIMARY KEY (category, difficulty)
+);
+
+CREATE OR REPLACE FUNCTION public.move_question_counts() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    target integer := 0;
+BEGIN
+    -- the foreign key sets the category of the questions to NULL, or cascades
+    -- the new id, the counts follow them
+    IF TG_OP = 'UPDATE' THEN
+        IF NEW.id = OLD.id THEN
+            RETURN NULL;
+        END IF;
+        target := NEW.id;
+    END IF;
+    INSERT INTO public.question_counts (category, difficulty, count)
+        SELECT target, difficulty, count FROM public.question_counts WHERE category = OLD.id
+        ON CONFLICT (category, difficulty) DO UPDATE SET count = question_counts.count + EXCLUDED.count;
+    DELETE FROM public.question_counts WHERE category = OLD.id;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS categories_move_question_counts ON public.categories;
+CREATE TRIGGER categories_move_question_counts AFTER DELETE OR UPDATE OF id ON public.categories
+    FOR EACH ROW EXECUTE PROCEDURE public.move_question_counts();
+
+BEGIN;
+-- no question is written while the existing ones are counted
+LOCK TABLE public.questions IN SHARE MODE;
+DELETE FROM public.question_counts;
+INSERT INTO public.question_counts (category, difficulty, count)
+    SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*)
+    FROM public.questions
+    GROUP BY coalesce(category, 0), coalesce(difficulty, 0);
+COMMIT;
@@ -0,0 +1,35 @@
+--
+-- Notify the trivia_changes channel of every write to questions and
+-- categories, with a {"table": ..., "id": ...} payload, so processes holding
+-- them in memory (QUESTION_STORE) pick up the writes of their peers.
+-- Notifications are only delivered when the transaction commits.
+--
+-- psql trivia < migrations/004_change_notifications.sql
+--
+
+CREATE OR REPLACE FUNCTION public.notify_trivia_change() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('trivia_changes', json_build_object('table', TG_TABLE_NAME, 'id', NEW.id)::text);
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify('trivia_changes', json_build_object('table', TG_TABLE_NAME, 'id', OLD.id)::text);
+    -- an update of the id also notifies the new one
+    IF TG_OP = 'UPDATE' THEN
+        IF NEW.id <> OLD.id THEN
+            PERFORM pg_notify('trivia_changes', json_build_object('table', TG_TABLE_NAME, 'id', NEW.id)::text);
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS questions_notify_change ON public.questions;
+CREATE TRIGGER questions_notify_change AFTER INSERT OR UPDATE OR DELETE ON public.questions
+    FOR EACH ROW EXECUTE PROCEDURE public.notify_trivia_change();
+
+DROP TRIGGER IF EXISTS categories_notify_change ON public.categories;
+CREATE TRIGGER categories_notify_change AFTER INSERT OR UPDATE OR DELETE ON public.categories
+    FOR EACH ROW EXECUTE PROCEDURE public.notify_trivia_change();
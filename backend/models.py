@@ -1,14 +1,17 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from db_pool import engine_options
+from routing import RoutingSession
+
 # database connection - secrets kept in .env file
 database_path = "postgresql://{}:{}@{}/{}".format(
     os.environ.get("DB_USER"), os.environ.get(
         "DB_PASSWORD"), f"{os.environ.get('DB_HOST')}:{os.environ.get('DB_PORT')}", os.environ.get("DB_NAME")
 )
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 """
 setup_db(app)
@@ -18,11 +21,17 @@ setup_db(app)
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # production databases are created by trivia.psql and migrations/, so
+    # skipping create_all() leaves the first connection to the first request
+    create_all = app.config.setdefault(
+        "DATABASE_CREATE_ALL", os.environ.get("DB_CREATE_ALL", "true").lower() in ("1", "true"))
     db.app = app
     db.init_app(app)
-    with app.app_context():
-        db.create_all()
+    if create_all:
+        with app.app_context():
+            db.create_all()
 
 
 """
@@ -33,11 +42,17 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # category listings and quiz selection filter by category, ordered by id
+        Index('questions_category_id_idx', 'category', 'id'),
+        Index('questions_difficulty_idx', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', name='category', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -87,3 +102,18 @@ class Category(db.Model):
         return {
             str(self.id): self.type
         }
+
+
+"""
+QuestionCount
+    number of questions per category and difficulty, kept up to date by the
+    writes so counting does not scan the questions table (see question_counts)
+"""
+
+
+class QuestionCount(db.Model):
+    __tablename__ = 'question_counts'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,379 @@
+"""Profiles of slow requests and plans of slow queries.
+
+Enabled with ``PROFILING``. A sample of the requests is run under a profiler,
+cProfile or pyinstrument. Requests slower than ``PROFILING_SLOW_REQUEST`` are
+recorded with their profile when they were sampled. SQL statements slower than
+``PROFILING_SLOW_QUERY`` are recorded with their plan:
+``EXPLAIN (ANALYZE, BUFFERS)`` on PostgreSQL, ``EXPLAIN QUERY PLAN`` on SQLite.
+The plan of a statement is taken at most once per ``PROFILING_PLAN_INTERVAL``.
+
+The Flask routes are hooked by ``init_app``, the async handlers of asgi.py
+through ``begin`` and ``end``.
+
+Plans are taken and records written by a background thread, after the
+response is sent, to JSON files of ``PROFILING_DIR``. Only the newest
+``PROFILING_MAX_FILES`` files are kept. ``GET /debug/profiles`` lists them for
+clients sending ``Authorization: Bearer <PROFILING_TOKEN>``.
+
+Disabled, no hook is registered and requests run exactly as without this
+module, see benchmarks/profiling.py.
+"""
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import math
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+# functions listed in a cProfile record, by cumulative time
+PROFILE_LINES = 40
+
+# characters of a statement kept in a record
+STATEMENT_LENGTH = 2000
+
+# ids of the recorded files: milliseconds since the epoch and a random suffix
+RECORD_ID = re.compile(r"^[0-9]+-[0-9a-f]{8}$")
+
+# endpoints browsing the records, never recorded themselves
+IGNORED = {"get_profiles", "get_profile"}
+
+# statements whose plan is taken by running them again, writes are not
+EXPLAINABLE = ("select", "with")
+
+# queries that lock or write rows, e.g. in a CTE, are not run again either
+LOCKING = re.compile(
+    r"\b(FOR\s+(NO\s+KEY\s+)?UPDATE|FOR\s+(KEY\s+)?SHARE|INSERT|UPDATE|DELETE)\b",
+    re.IGNORECASE)
+
+# statements whose last plan time is kept, expired ones are dropped beyond
+PLANNED_STATEMENTS = 1000
+
+# slow statements of the request being served, None outside of one
+_queries = contextvars.ContextVar("profiling_queries", default=None)
+
+
+class _Request:
+    """State of a request between Profiler.begin and Profiler.end"""
+
+    def __init__(self, token, profile):
+        self.started = time.perf_counter()
+        self.token = token
+        self.profile = profile
+
+
+class Profiler:
+    """Sampled profiles of slow requests and plans of slow statements.
+
+    Configured from ``PROFILING``, ``PROFILING_ENGINE`` (``cprofile`` or
+    ``pyinstrument``, needs ``pip install pyinstrument``),
+    ``PROFILING_SAMPLE_RATE`` (fraction of the requests profiled),
+    ``PROFILING_SLOW_REQUEST`` and ``PROFILING_SLOW_QUERY`` in seconds,
+    ``PROFILING_PLAN_INTERVAL`` (seconds between two plans of a statement),
+    ``PROFILING_DIR``, ``PROFILING_MAX_FILES`` and ``PROFILING_TOKEN``.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.engine = "cprofile"
+        self.sample_rate = 0.05
+        self.slow_request = 0.5
+        self.slow_query = 0.1
+        self.plan_interval = 60
+        self.directory = None
+        self.max_files = 200
+        self.token = ""
+        self.app = None
+        self._pyinstrument = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # statement -> time its plan was last taken, by the background thread
+        self._planned = {}
+        self.recorded = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault(
+            "PROFILING", os.environ.get("PROFILING", "false").lower() in ("1", "true"))
+        self.engine = app.config.setdefault(
+            "PROFILING_ENGINE", os.environ.get("PROFILING_ENGINE", "cprofile"))
+        self.sample_rate = app.config.setdefault(
+            "PROFILING_SAMPLE_RATE", float(os.environ.get("PROFILING_SAMPLE_RATE", 0.05)))
+        self.slow_request = app.config.setdefault(
+            "PROFILING_SLOW_REQUEST", float(os.environ.get("PROFILING_SLOW_REQUEST", 0.5)))
+        self.slow_query = app.config.setdefault(
+            "PROFILING_SLOW_QUERY", float(os.environ.get("PROFILING_SLOW_QUERY", 0.1)))
+        self.plan_interval = app.config.setdefault(
+            "PROFILING_PLAN_INTERVAL", float(os.environ.get("PROFILING_PLAN_INTERVAL", 60)))
+        self.directory = app.config.setdefault(
+            "PROFILING_DIR", os.environ.get(
+                "PROFILING_DIR", os.path.join(tempfile.gettempdir(), "trivia-profiles")))
+        self.max_files = app.config.setdefault(
+            "PROFILING_MAX_FILES", int(os.environ.get("PROFILING_MAX_FILES", 200)))
+        self.token = app.config.setdefault(
+            "PROFILING_TOKEN", os.environ.get("PROFILING_TOKEN", ""))
+        self._pyinstrument = None
+        self._planned = {}
+        if not self.enabled:
+            return
+        if self.engine == "pyinstrument":
+            import pyinstrument
+            self._pyinstrument = pyinstrument
+        elif self.engine != "cprofile":
+            raise ValueError(f"unknown PROFILING_ENGINE {self.engine!r}")
+        os.makedirs(self.directory, exist_ok=True)
+        _listen_to_statements()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start_request(self):
+        g.profiling_request = self.begin(request.endpoint)
+
+    def _finish_request(self, response):
+        state = g.pop("profiling_request", None)
+        if state is not None:
+            self.end(state, request.method,
+                     request.full_path if request.query_string else request.path,
+                     request.endpoint, response.status_code)
+        return response
+
+    def _teardown_request(self, error):
+        # a request that failed before after_request must not leave its
+        # thread profiled
+        state = g.pop("profiling_request", None)
+        if state is not None:
+            self._stop(state)
+
+    def begin(self, endpoint, asynchronous=False):
+        """Start timing a request, profiled when sampled. Returns the state
+        to pass to ``end``, None when the request is not recorded.
+
+        ``asynchronous`` requests run on an event loop, only pyinstrument
+        can profile them apart from the other tasks.
+        """
+        if endpoint in IGNORED:
+            return None
+        profile = None
+        if random.random() < self.sample_rate:
+            if self._pyinstrument is not None:
+                profile = self._pyinstrument.Profiler(
+                    async_mode="enabled" if asynchronous else "disabled")
+                profile.start()
+            elif not asynchronous:
+                profile = cProfile.Profile()
+                profile.enable()
+        return _Request(_queries.set([]), profile)
+
+    def end(self, state, method, path, endpoint, status):
+        """Record the request started by ``begin`` if it was slow or ran slow
+        statements"""
+        duration = time.perf_counter() - state.started
+        queries = self._stop(state)
+        if duration >= self.slow_request or queries:
+            self._start()
+            self._queue.put({
+                "method": method,
+                "path": path,
+                "endpoint": endpoint,
+                "status": status,
+                "duration": duration,
+                "slow": duration >= self.slow_request,
+                "profile": state.profile if duration >= self.slow_request else None,
+                "queries": queries,
+            })
+
+    def _stop(self, state):
+        # in the thread, or task, that started it
+        if state.profile is not None:
+            if self._pyinstrument is not None:
+                state.profile.stop()
+            else:
+                state.profile.disable()
+        queries = _queries.get()
+        _queries.reset(state.token)
+        return queries
+
+    def _start(self):
+        # started by the first record, after any fork of the server
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="profiling", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self._write(record)
+            # any error, the next records must still be written
+            except Exception as e:
+                self.app.logger.exception(e)
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """Block until the records of finished requests are written"""
+        self._queue.join()
+
+    def _write(self, record):
+        profile = record.pop("profile")
+        if profile is None:
+            record["profile"] = None
+        elif self._pyinstrument is not None:
+            record["profile"] = profile.output_text()
+        else:
+            # imported by the first record, starting the app does not need it
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            record["profile"] = stream.getvalue()
+        record["queries"] = [
+            {"statement": statement[:STATEMENT_LENGTH], "duration": duration,
+             "plan": self._plan(engine, statement, parameters)}
+            for engine, statement, parameters, duration in record["queries"]]
+        record_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        record["id"] = record_id
+        path = os.path.join(self.directory, f"{record_id}.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(record, file, default=str)
+        # renamed once complete, readers never see a partial file
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.recorded += 1
+        self._rotate()
+
+    def _plan(self, engine, statement, parameters):
+        """Plan of a statement, None when one was taken less than
+        ``plan_interval`` ago: running it again costs as much as it did"""
+        now = time.monotonic()
+        if now - self._planned.get(statement, -math.inf) < self.plan_interval:
+            return None
+        if len(self._planned) >= PLANNED_STATEMENTS:
+            self._planned = {planned: at for planned, at in self._planned.items()
+                             if now - at < self.plan_interval}
+        self._planned[statement] = now
+        if engine.dialect.is_async:
+            # from the async handlers, their engine cannot be used from this
+            # thread, the app's engine connects to the same database
+            with self.app.app_context():
+                return explain(db.engine, statement, parameters)
+        return explain(engine, statement, parameters)
+
+    def _rotate(self):
+        for name in self._record_names()[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _record_names(self):
+        """File names of the records, newest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((name for name in names if name.endswith(".json")),
+                      key=lambda name: int(name.split("-", 1)[0]), reverse=True)
+
+    def authorized(self, authorization):
+        """Whether the ``Authorization`` header carries the token"""
+        if not self.token or authorization is None:
+            return False
+        return hmac.compare_digest(authorization.encode(), f"Bearer {self.token}".encode())
+
+    def records(self):
+        """Summaries of the records, newest first"""
+        summaries = []
+        for name in self._record_names():
+            record = self.get(name[:-len(".json")])
+            if record is None:
+                continue
+            summaries.append({
+                "id": record["id"], "method": record["method"], "path": record["path"],
+                "status": record["status"], "duration": record["duration"],
+                "slow": record["slow"], "profiled": record["profile"] is not None,
+                "slow_queries": len(record["queries"]),
+            })
+        return summaries
+
+    def get(self, record_id):
+        """A record, None when it does not exist or was rotated out"""
+        if not RECORD_ID.match(record_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{record_id}.json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+
+profiler = Profiler()
+
+
+def explain(engine, statement, parameters):
+    """Plan of a statement as lines of text, None when it is not a read-only
+    query or the database has no supported EXPLAIN"""
+    if not statement.lstrip().lower().startswith(EXPLAINABLE) or LOCKING.search(statement):
+        return None
+    if engine.dialect.name == "postgresql":
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+    elif engine.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        return None
+    with engine.connect() as connection:
+        # ANALYZE runs the statement, whatever it does is rolled back
+        transaction = connection.begin()
+        try:
+            rows = connection.exec_driver_sql(prefix + statement, parameters).all()
+        finally:
+            transaction.rollback()
+    return [" ".join(str(value) for value in row) for row in rows]
+
+
+_listening = False
+
+
+def _listen_to_statements():
+    # registered once, for every engine, by the first app enabling profiling
+    global _listening
+    if _listening:
+        return
+    _listening = True
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiling_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["profiling_query_start"].pop()
+    queries = _queries.get()
+    if queries is not None and not executemany and duration >= profiler.slow_query:
+        queries.append((conn.engine, statement, parameters, duration))
+
+
+def _handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("profiling_query_start")
+        if starts:
+            starts.pop()
@@ -0,0 +1,104 @@
+"""Question counts per category and difficulty.
+
+The ``question_counts`` table is updated in the transaction of every write to
+the questions table, so totals are summed from a few rows (categories times
+difficulties) instead of counting the questions. The application never
+deletes a category nor changes its id; on PostgreSQL the trigger of
+migrations/003_question_counts.sql moves the counts when it is done around
+it, elsewhere call rebuild.
+"""
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.sql import func
+from werkzeug.utils import import_string
+
+from models import Question, QuestionCount, db
+
+# stands for a NULL category (deleted category) or difficulty
+UNKNOWN = 0
+
+# dialects with INSERT ... ON CONFLICT DO UPDATE, imported by the first write
+UPSERTS = {"postgresql": "sqlalchemy.dialects.postgresql:insert",
+           "sqlite": "sqlalchemy.dialects.sqlite:insert"}
+
+
+def key(category, difficulty):
+    """Row of the counts a question with these columns belongs to"""
+    return (UNKNOWN if category is None else int(category),
+            UNKNOWN if difficulty is None else int(difficulty))
+
+
+def apply(deltas):
+    """Add ``deltas``, a mapping of (category, difficulty) to a number of
+    questions, within the current transaction"""
+    upsert = UPSERTS.get(db.engine.dialect.name)
+    if upsert is not None:
+        upsert = import_string(upsert)
+    # a consistent order, so concurrent writers lock the rows without deadlocks
+    for (category, difficulty), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        if upsert is not None:
+            statement = upsert(QuestionCount).values(
+                category=category, difficulty=difficulty, count=delta)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[QuestionCount.category, QuestionCount.difficulty],
+                set_={"count": QuestionCount.count + statement.excluded.count}))
+            continue
+        updated = db.session.execute(
+            update(QuestionCount)
+            .where(QuestionCount.category == category,
+                   QuestionCount.difficulty == difficulty)
+            .values(count=QuestionCount.count + delta))
+        if not updated.rowcount:
+            db.session.execute(insert(QuestionCount).values(
+                category=category, difficulty=difficulty, count=delta))
+
+
+def increment(category, difficulty, delta=1):
+    """Count a created question, or a deleted one with ``delta=-1``"""
+    apply({key(category, difficulty): delta})
+
+
+def total_statement(category_id=None):
+    """SELECT of the number of questions, of one category if given"""
+    statement = select(func.coalesce(func.sum(QuestionCount.count), 0))
+    if category_id is not None:
+        statement = statement.where(QuestionCount.category == category_id)
+    return statement
+
+
+def total(category_id=None):
+    return db.session.scalar(total_statement(category_id))
+
+
+def stats():
+    """Totals overall, per category and per difficulty. Categories are
+    listed with their count per difficulty."""
+    categories = {}
+    difficulties = {}
+    rows = db.session.execute(select(
+        QuestionCount.category, QuestionCount.difficulty, QuestionCount.count)
+        .where(QuestionCount.count > 0)
+        .order_by(QuestionCount.category, QuestionCount.difficulty))
+    for category, difficulty, count in rows:
+        entry = categories.setdefault(
+            str(category), {"total_questions": 0, "difficulties": {}})
+        entry["total_questions"] += count
+        entry["difficulties"][str(difficulty)] = count
+        difficulties[str(difficulty)] = difficulties.get(str(difficulty), 0) + count
+    return {
+        "total_questions": sum(difficulties.values()),
+        "categories": categories,
+        "difficulties": difficulties,
+    }
+
+
+def rebuild():
+    """Recount every question, within the current transaction. For data
+    written around the application, like the benchmark seed."""
+    category = func.coalesce(Question.category, UNKNOWN)
+    difficulty = func.coalesce(Question.difficulty, UNKNOWN)
+    db.session.execute(delete(QuestionCount))
+    db.session.execute(insert(QuestionCount).from_select(
+        ["category", "difficulty", "count"],
+        select(category, difficulty, func.count()).group_by(category, difficulty)))
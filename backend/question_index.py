@@ -0,0 +1,243 @@
+import os
+import random
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from models import Question, db
+
+# seconds before the index is reloaded to pick up writes of other processes
+QUESTION_INDEX_TTL = int(os.environ.get("QUESTION_INDEX_TTL", 60))
+
+# rejection sampling attempts before falling back to a full candidate scan
+SAMPLE_ATTEMPTS = 8
+
+# key of the bucket holding every question (category "ALL")
+ALL_CATEGORIES = 0
+
+
+class QuestionIndex:
+    """In-process index of question ids per category, and per category and
+    difficulty.
+
+    Quiz selection draws ids from this index instead of asking the database to
+    sort every candidate row with ``ORDER BY random()``. Ids are kept in compact
+    integer arrays, so picking a random question is O(1) as long as the ids to
+    exclude are few compared to the candidates. The position of every id in its
+    arrays is kept too, a deleted question is replaced by the last id of each
+    array instead of shifting the ones after it.
+    """
+
+    def __init__(self, ttl=QUESTION_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._buckets = None
+        # category -> difficulty -> ids
+        self._difficulties = None
+        # id -> (category, difficulty, position in each array of _arrays)
+        self._positions = None
+        self._loaded_at = 0
+        # one reload from the database at a time, run without ``_lock``
+        self._load_lock = threading.Lock()
+        # (added, args) writes made while a reload reads the rows, replayed
+        # onto its arrays. None when no reload runs or it was invalidated
+        self._pending = None
+        # callable returning the (id, category, difficulty) rows to load, or
+        # None to query the database, set by question_store
+        self.source = None
+
+    def expired(self, margin=0):
+        """Whether the index must be (re)loaded, or will be within ``margin``
+        seconds"""
+        return (self._buckets is None
+                or time.monotonic() - self._loaded_at > self.ttl - margin)
+
+    def load(self, rows):
+        """Replace the index with (question id, category id, difficulty) rows"""
+        built = self._build(rows)
+        with self._lock:
+            self._replace(*built)
+
+    @classmethod
+    def _build(cls, rows):
+        index = {ALL_CATEGORIES: array("l")}, {ALL_CATEGORIES: {}}, {}
+        for question_id, category_id, difficulty in rows:
+            cls._insert(index, question_id, category_id, difficulty)
+        return index
+
+    def _replace(self, buckets, difficulties, positions):
+        self._buckets = buckets
+        self._difficulties = difficulties
+        self._positions = positions
+        self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _arrays(index, category_id, difficulty):
+        """Arrays holding a question: every question, every question of its
+        difficulty, its category, its category and difficulty. None for the
+        ones it is not in, without category or difficulty."""
+        buckets, difficulties, _ = index
+        arrays = []
+        for key in (ALL_CATEGORIES, category_id):
+            if key is None:
+                arrays.extend((None, None))
+                continue
+            arrays.append(buckets.setdefault(key, array("l")))
+            arrays.append(None if difficulty is None else
+                          difficulties.setdefault(key, {}).setdefault(difficulty, array("l")))
+        return arrays
+
+    @classmethod
+    def _insert(cls, index, question_id, category_id, difficulty):
+        positions = index[2]
+        if question_id in positions:
+            return
+        category_id = None if category_id is None else int(category_id)
+        difficulty = None if difficulty is None else int(difficulty)
+        slots = array("l")
+        for ids in cls._arrays(index, category_id, difficulty):
+            slots.append(-1 if ids is None else len(ids))
+            if ids is not None:
+                ids.append(question_id)
+        positions[question_id] = (category_id, difficulty, slots)
+
+    @classmethod
+    def _remove(cls, index, *question_ids):
+        positions = index[2]
+        for question_id in question_ids:
+            if question_id not in positions:
+                continue
+            category_id, difficulty, slots = positions.pop(question_id)
+            for slot, ids in enumerate(cls._arrays(index, category_id, difficulty)):
+                if ids is None:
+                    continue
+                # the last id of the array takes the place of the removed one
+                last = ids.pop()
+                if last != question_id:
+                    ids[slots[slot]] = last
+                    positions[last][2][slot] = slots[slot]
+
+    def _ensure_loaded(self, load):
+        # the rows are read and the arrays built without ``_lock``, samplers
+        # keep drawing from the previous index meanwhile, or wait for the
+        # reload when there is none
+        if not self.expired():
+            return
+        if not load:
+            if self._buckets is None:
+                raise LookupError("question index not loaded")
+            return
+        if not self._load_lock.acquire(blocking=self._buckets is None):
+            return
+        try:
+            if not self.expired():
+                return
+            with self._lock:
+                self._pending = []
+            rows = self.source() if self.source is not None else None
+            if rows is None:
+                rows = db.session.query(Question.id, Question.category, Question.difficulty)
+            index = self._build(rows)
+            with self._lock:
+                if self._pending is None:
+                    # invalidated meanwhile, the rows may predate it
+                    return
+                for added, args in self._pending:
+                    if added:
+                        self._insert(index, *args)
+                    else:
+                        self._remove(index, *args)
+                self._replace(*index)
+        finally:
+            with self._lock:
+                self._pending = None
+            self._load_lock.release()
+
+    @contextmanager
+    def _loaded(self, load):
+        """Hold the lock over the loaded index, see ``_ensure_loaded``"""
+        while True:
+            self._ensure_loaded(load)
+            with self._lock:
+                # unless invalidated since
+                if self._buckets is not None:
+                    yield
+                    return
+
+    def invalidate(self):
+        """Drop the index, it is reloaded on next use"""
+        with self._lock:
+            self._buckets = None
+            self._difficulties = None
+            self._positions = None
+            self._pending = None
+
+    def add(self, question_id, category_id, difficulty):
+        """Register a newly created question"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((True, (question_id, category_id, difficulty)))
+            if self._buckets is None:
+                return
+            self._insert(self._index(), question_id, category_id, difficulty)
+
+    def remove(self, *question_ids):
+        """Forget deleted questions"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((False, question_ids))
+            if self._buckets is None:
+                return
+            self._remove(self._index(), *question_ids)
+
+    def _index(self):
+        return self._buckets, self._difficulties, self._positions
+
+    def sample(self, category_id, exclude=(), difficulty=None, load=True):
+        """Randomly pick a question id of the category (0 for all) that is not
+        in ``exclude``. Returns None when no candidate is left.
+
+        With ``difficulty``, the question is picked among those of that
+        difficulty, or of the nearest one that still has candidates.
+
+        Without ``load``, a missing index raises LookupError instead of being
+        loaded from the database, see ``load``.
+        """
+        exclude = set(exclude)
+        with self._loaded(load):
+            if difficulty is None:
+                return self._pick(self._buckets.get(int(category_id), ()), exclude)
+            levels = self._difficulties.get(int(category_id), {})
+            for level in sorted(levels, key=lambda level: (abs(level - difficulty), level)):
+                question_id = self._pick(levels[level], exclude)
+                if question_id is not None:
+                    return question_id
+        return None
+
+    @staticmethod
+    def _pick(candidates, exclude):
+        # cheap path: candidates clearly outnumber the excluded ids
+        if len(candidates) > 2 * len(exclude):
+            for _ in range(SAMPLE_ATTEMPTS):
+                question_id = random.choice(candidates)
+                if question_id not in exclude:
+                    return question_id
+        # few questions left, pick among the remaining ones
+        remaining = [id for id in candidates if id not in exclude]
+        return random.choice(remaining) if remaining else None
+
+    def sample_many(self, category_id, count, exclude=(), load=True):
+        """Randomly pick up to ``count`` distinct question ids of the category
+        (0 for all) that are not in ``exclude``. ``load`` as for ``sample``."""
+        exclude = set(exclude)
+        with self._loaded(load):
+            candidates = self._buckets.get(int(category_id), ())
+            if len(candidates) > 2 * (count + len(exclude)):
+                picked = random.sample(candidates, count + len(exclude))
+                return [id for id in picked if id not in exclude][:count]
+            remaining = [id for id in candidates if id not in exclude]
+        return random.sample(remaining, min(count, len(remaining)))
+
+
+question_index = QuestionIndex()
@@ -0,0 +1,495 @@
+"""In-process store of every question, serving the read endpoints.
+
+Enabled with ``QUESTION_STORE``, each process loads the questions once and
+answers listings, category listings, pagination and the rows of quiz questions
+from memory, without a query. Columns are kept apart in compact arrays and the
+texts as UTF-8, back to back in one buffer: a few times smaller than rows of
+Python objects, see benchmarks/question_store.py.
+
+Writes of this process are applied once committed. Writes of other processes
+are announced by triggers on the questions and categories tables
+(migrations/004_change_notifications.sql) with Postgres NOTIFY, which a
+background thread LISTENs to. The thread also reloads everything every
+``QUESTION_STORE_RESYNC`` seconds in case notifications were missed, the only
+way to see other writers on databases without LISTEN. Until the first load is
+done, the views query the database.
+"""
+import bisect
+import json
+import os
+import select
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+from category_cache import category_cache
+from models import Question, db
+from question_index import question_index
+from response_cache import response_cache
+import serialization
+from streaming import QUESTION_COLUMNS
+
+# channel of the notifications sent by the triggers
+CHANNEL = "trivia_changes"
+
+# rows per query while loading, each chunk in its own short transaction
+LOAD_CHUNK = 10000
+
+# seconds before the thread starts over after an error, e.g. a lost connection
+RETRY_DELAY = 5
+
+# longest wait of the thread, so it notices a new configuration
+POLL_INTERVAL = 1
+
+# stands for NULL in the integer columns
+NULL = -2 ** 31
+
+
+def _value(stored):
+    return None if stored == NULL else stored
+
+
+def _stored(value):
+    return NULL if value is None else int(value)
+
+
+class StoredQuestion(namedtuple("StoredQuestion", [column.key for column in QUESTION_COLUMNS])):
+    """A question of the store, like the rows selected with QUESTION_COLUMNS"""
+
+    __slots__ = ()
+
+    def format(self):
+        return self._asdict()
+
+
+class TextColumn:
+    """Strings encoded as UTF-8 back to back in one buffer, with their start
+    and length. Replaced and deleted strings leave their bytes behind until
+    the next load."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.starts = array("Q")
+        # -1 for None
+        self.lengths = array("i")
+        self.garbage = 0
+
+    def _encode(self, value):
+        if value is None:
+            return len(self.buffer), -1
+        encoded = value.encode()
+        start = len(self.buffer)
+        self.buffer += encoded
+        return start, len(encoded)
+
+    def __getitem__(self, position):
+        length = self.lengths[position]
+        if length < 0:
+            return None
+        start = self.starts[position]
+        return self.buffer[start:start + length].decode()
+
+    def extend(self, values):
+        for value in values:
+            start, length = self._encode(value)
+            self.starts.append(start)
+            self.lengths.append(length)
+
+    def insert(self, position, value):
+        start, length = self._encode(value)
+        self.starts.insert(position, start)
+        self.lengths.insert(position, length)
+
+    def replace(self, position, value):
+        self.garbage += max(self.lengths[position], 0)
+        self.starts[position], self.lengths[position] = self._encode(value)
+
+    def delete(self, position):
+        self.garbage += max(self.lengths[position], 0)
+        del self.starts[position]
+        del self.lengths[position]
+
+    def nbytes(self):
+        return (len(self.buffer) + self.starts.itemsize * len(self.starts)
+                + self.lengths.itemsize * len(self.lengths))
+
+
+class Columns:
+    """The questions sorted by id, one array per column"""
+
+    def __init__(self):
+        self.ids = array("l")
+        self.questions = TextColumn()
+        self.answers = TextColumn()
+        self.categories = array("i")
+        self.difficulties = array("i")
+        # category -> sorted ids
+        self.by_category = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, question_id):
+        position = bisect.bisect_left(self.ids, question_id)
+        if position < len(self.ids) and self.ids[position] == question_id:
+            return position
+        return None
+
+    def row(self, position):
+        return StoredQuestion(
+            self.ids[position], self.questions[position], self.answers[position],
+            _value(self.categories[position]), _value(self.difficulties[position]))
+
+    def put(self, row):
+        """Insert or replace a question, return the replaced one"""
+        position = bisect.bisect_left(self.ids, row.id)
+        if position < len(self.ids) and self.ids[position] == row.id:
+            replaced = self.row(position)
+            self.questions.replace(position, row.question)
+            self.answers.replace(position, row.answer)
+            self.categories[position] = _stored(row.category)
+            self.difficulties[position] = _stored(row.difficulty)
+            if replaced.category != row.category:
+                self._unlist(row.id, replaced.category)
+                self._list(row.id, row.category)
+            return replaced
+        self.ids.insert(position, row.id)
+        self.questions.insert(position, row.question)
+        self.answers.insert(position, row.answer)
+        self.categories.insert(position, _stored(row.category))
+        self.difficulties.insert(position, _stored(row.difficulty))
+        self._list(row.id, row.category)
+        return None
+
+    def extend(self, rows):
+        """Add questions sorted by id, with ids greater than those stored,
+        column by column while loading"""
+        if not rows:
+            return
+        ids, questions, answers, categories, difficulties = zip(*rows)
+        categories = [_stored(category) for category in categories]
+        self.ids.extend(ids)
+        self.questions.extend(questions)
+        self.answers.extend(answers)
+        self.categories.extend(categories)
+        self.difficulties.extend(map(_stored, difficulties))
+        for question_id, category in zip(ids, categories):
+            self.by_category.setdefault(category, array("l")).append(question_id)
+
+    def discard(self, question_id):
+        """Remove a question, return it, None when it is not stored"""
+        position = self.position(question_id)
+        if position is None:
+            return None
+        removed = self.row(position)
+        del self.ids[position]
+        self.questions.delete(position)
+        self.answers.delete(position)
+        del self.categories[position]
+        del self.difficulties[position]
+        self._unlist(question_id, removed.category)
+        return removed
+
+    def _list(self, question_id, category_id):
+        bisect.insort(self.by_category.setdefault(_stored(category_id), array("l")), question_id)
+
+    def _unlist(self, question_id, category_id):
+        ids = self.by_category.get(_stored(category_id))
+        position = bisect.bisect_left(ids, question_id)
+        del ids[position]
+
+    def nbytes(self):
+        arrays = [self.ids, self.categories, self.difficulties, *self.by_category.values()]
+        return (sum(values.itemsize * len(values) for values in arrays)
+                + self.questions.nbytes() + self.answers.nbytes())
+
+
+class QuestionStore:
+    """Every question in memory, kept coherent with the database.
+
+    Configured from ``QUESTION_STORE`` and ``QUESTION_STORE_RESYNC``: seconds
+    between full reloads.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.resync_interval = 300
+        self.app = None
+        self._columns = None
+        self._lock = threading.Lock()
+        self._thread = None
+        # bumped by init_app, a thread of a previous configuration stops
+        self._generation = 0
+        # (put, row or id) writes made while a resync reads the questions,
+        # replayed onto its columns. None when no resync runs
+        self._pending = None
+        self._reset()
+
+    def _reset(self):
+        self.listening = False
+        self.resyncs = 0
+        self.notifications = 0
+        self.last_resync_seconds = 0
+        self._resynced_at = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault(
+            "QUESTION_STORE", os.environ.get("QUESTION_STORE", "false").lower() in ("1", "true"))
+        self.resync_interval = app.config.setdefault(
+            "QUESTION_STORE_RESYNC", int(os.environ.get("QUESTION_STORE_RESYNC", 300)))
+        with self._lock:
+            self._generation += 1
+            self._columns = None
+            self._pending = None
+            self._reset()
+        question_index.source = self.index_rows if self.enabled else None
+        if self.enabled:
+            app.before_request(self._start)
+
+    @property
+    def ready(self):
+        return self._columns is not None
+
+    def _start(self):
+        # started by the first request, after any fork of the server
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._generation,),
+                    name="question-store", daemon=True)
+                self._thread.start()
+
+    def _run(self, generation):
+        fresh = self._resynced_at is not None
+        while generation == self._generation:
+            try:
+                with self.app.app_context():
+                    self._listen(generation, fresh)
+            # any error, the store must not stop following the database
+            except Exception as e:
+                self.app.logger.exception(e)
+                time.sleep(RETRY_DELAY)
+            # notifications may have been missed meanwhile
+            fresh = False
+
+    def _listen(self, generation, fresh):
+        listener = None
+        if db.engine.dialect.driver == "psycopg2":
+            # outside of the pool and in autocommit, notifications are only
+            # delivered between transactions
+            listener = create_engine(
+                db.engine.url, poolclass=NullPool, isolation_level="AUTOCOMMIT").connect()
+        try:
+            if listener is not None:
+                listener.execute(text(f"LISTEN {CHANNEL}"))
+                self.listening = True
+            # loaded after LISTEN, no write is missed in between
+            if not fresh:
+                self.resync(generation)
+            while generation == self._generation:
+                remaining = self._resynced_at + self.resync_interval - time.monotonic()
+                if remaining <= 0:
+                    self.resync(generation)
+                    continue
+                if listener is None:
+                    time.sleep(min(remaining, POLL_INTERVAL))
+                    continue
+                connection = listener.connection.dbapi_connection
+                if select.select([connection], [], [], min(remaining, POLL_INTERVAL))[0]:
+                    connection.poll()
+                    changes = [json.loads(notify.payload) for notify in connection.notifies]
+                    connection.notifies.clear()
+                    if changes:
+                        self._apply(changes)
+        finally:
+            self.listening = False
+            if listener is not None:
+                listener.close()
+
+    def _apply(self, changes):
+        """Follow the writes announced by notifications, most of them made by
+        other processes, doing what their views did to their own caches"""
+        self.notifications += len(changes)
+        if any(change["table"] == "categories" for change in changes):
+            category_cache.invalidate()
+            response_cache.invalidate("categories")
+        question_ids = {change["id"] for change in changes if change["table"] == "questions"}
+        if not question_ids:
+            return
+        question_ids = sorted(question_ids)
+        try:
+            # a bulk import notifies as many ids as it inserted
+            for start in range(0, len(question_ids), LOAD_CHUNK):
+                chunk = question_ids[start:start + LOAD_CHUNK]
+                rows, previous = self.refresh(*chunk)
+                # quizzes draw from the index, a question may have changed category
+                question_index.remove(*chunk)
+                for row in rows:
+                    question_index.add(row.id, row.category, row.difficulty)
+                serialization.invalidate(*chunk)
+                response_cache.invalidate("questions", *{
+                    f"category:{row.category}" for row in [*rows, *previous]})
+        finally:
+            # the listener thread keeps its app context, the connection must
+            # not stay checked out, idle in transaction, until the next batch
+            db.session.close()
+
+    def resync(self, generation=None):
+        """Load every question, in chunks by id, and swap them in at once.
+        The writes applied meanwhile are replayed onto the new columns."""
+        started = time.perf_counter()
+        columns = Columns()
+        last_id = None
+        with self._lock:
+            self._pending = []
+        try:
+            while True:
+                query = db.session.query(*QUESTION_COLUMNS).order_by(Question.id)
+                if last_id is not None:
+                    query = query.filter(Question.id > last_id)
+                rows = query.limit(LOAD_CHUNK).all()
+                db.session.close()
+                columns.extend(rows)
+                if len(rows) < LOAD_CHUNK:
+                    break
+                last_id = rows[-1].id
+            with self._lock:
+                if generation is not None and generation != self._generation:
+                    return
+                for put, value in self._pending:
+                    if put:
+                        columns.put(value)
+                    else:
+                        columns.discard(value)
+                self._columns = columns
+                self._resynced_at = time.monotonic()
+                self.resyncs += 1
+                self.last_resync_seconds = time.perf_counter() - started
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _put(self, row):
+        # with the lock held, also recorded for a resync running, the first
+        # one included
+        if self._pending is not None:
+            self._pending.append((True, row))
+        return self._columns.put(row) if self._columns is not None else None
+
+    def _discard(self, question_id):
+        # with the lock held
+        if self._pending is not None:
+            self._pending.append((False, question_id))
+        return self._columns.discard(question_id) if self._columns is not None else None
+
+    def put(self, *rows):
+        """Add or replace committed questions, rows with the attributes of
+        QUESTION_COLUMNS"""
+        with self._lock:
+            for row in rows:
+                self._put(StoredQuestion(*row))
+
+    def discard(self, *question_ids):
+        """Forget deleted questions"""
+        with self._lock:
+            for question_id in question_ids:
+                self._discard(question_id)
+
+    def refresh(self, *question_ids):
+        """Reload questions from the database, forgetting the deleted ones.
+        Returns the rows loaded and the rows they replaced or deleted."""
+        if not self.ready and self._pending is None:
+            return [], []
+        rows = [StoredQuestion(*row) for row in db.session.query(
+            *QUESTION_COLUMNS).filter(Question.id.in_(question_ids))]
+        found = {row.id for row in rows}
+        with self._lock:
+            if self._columns is None and self._pending is None:
+                return [], []
+            previous = [self._put(row) for row in rows]
+            previous.extend(self._discard(id) for id in question_ids if id not in found)
+        return rows, [row for row in previous if row is not None]
+
+    def catch_up(self):
+        """Load the questions created after the last one stored, e.g. by a
+        bulk import whose ids are not known"""
+        with self._lock:
+            if self._columns is None:
+                return
+            last_id = self._columns.ids[-1] if len(self._columns) else None
+        query = db.session.query(*QUESTION_COLUMNS)
+        if last_id is not None:
+            query = query.filter(Question.id > last_id)
+        try:
+            self.put(*query)
+        finally:
+            db.session.close()
+
+    def page(self, page, per_page, after_id=None):
+        """Questions of a listing page, or after the id ``after_id``, and the
+        number of questions. None until loaded."""
+        with self._lock:
+            columns = self._columns
+            if columns is None:
+                return None
+            if after_id is None:
+                start = (page - 1) * per_page
+            else:
+                start = bisect.bisect_right(columns.ids, after_id)
+            end = min(start + per_page, len(columns))
+            return [columns.row(position) for position in range(start, end)], len(columns)
+
+    def category(self, category_id):
+        """Questions of a category, sorted by id. None until loaded."""
+        with self._lock:
+            columns = self._columns
+            if columns is None:
+                return None
+            return [columns.row(columns.position(id))
+                    for id in columns.by_category.get(_stored(category_id), ())]
+
+    def get_many(self, question_ids):
+        """Stored questions of ``question_ids`` by id, missing ones are
+        deleted. None until loaded."""
+        with self._lock:
+            columns = self._columns
+            if columns is None:
+                return None
+            positions = ((id, columns.position(id)) for id in question_ids)
+            return {id: columns.row(position) for id, position in positions
+                    if position is not None}
+
+    def index_rows(self):
+        """(id, category, difficulty) rows for question_index, None until
+        loaded"""
+        with self._lock:
+            columns = self._columns
+            if columns is None:
+                return None
+            return list(zip(columns.ids,
+                            map(_value, columns.categories),
+                            map(_value, columns.difficulties)))
+
+    def stats(self):
+        with self._lock:
+            columns = self._columns
+            return {
+                "enabled": self.enabled,
+                "ready": columns is not None,
+                "listening": self.listening,
+                "questions": len(columns) if columns is not None else 0,
+                "bytes": columns.nbytes() if columns is not None else 0,
+                "garbage_bytes": (columns.questions.garbage + columns.answers.garbage
+                                  if columns is not None else 0),
+                "resyncs": self.resyncs,
+                "last_resync_seconds": self.last_resync_seconds,
+                "notifications": self.notifications,
+            }
+
+
+question_store = QuestionStore()
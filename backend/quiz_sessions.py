@@ -0,0 +1,45 @@
+import os
+import secrets
+
+from lru import LRUCache
+
+# seconds a play may last before its session is dropped
+QUIZ_SESSION_TTL = int(os.environ.get("QUIZ_SESSION_TTL", 3600))
+
+# maximum number of plays held at once, least recently used ones are dropped
+QUIZ_SESSION_MAX = int(os.environ.get("QUIZ_SESSION_MAX", 10000))
+
+
+class QuizSessionStore:
+    """Server-held plays.
+
+    Each session is a pre-shuffled sequence of question ids, so the client only
+    sends its token instead of the full list of previous questions.
+    """
+
+    def __init__(self, maxsize=QUIZ_SESSION_MAX, ttl=QUIZ_SESSION_TTL):
+        self._sessions = LRUCache(maxsize, ttl)
+
+    def create(self, question_ids):
+        """Start a play over ``question_ids`` and return its token"""
+        token = secrets.token_urlsafe(16)
+        # reversed so the next question is popped from the end
+        self._sessions.set(token, list(reversed(question_ids)))
+        return token
+
+    def next_question_id(self, token):
+        """Id of the next question of the play, None once it is over.
+        Raises KeyError for unknown or expired tokens."""
+        remaining = self._sessions.get(token)
+        if remaining is None:
+            raise KeyError(token)
+        try:
+            return remaining.pop()
+        except IndexError:
+            return None
+
+    def clear(self):
+        self._sessions.clear()
+
+
+quiz_sessions = QuizSessionStore()
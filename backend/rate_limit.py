@@ -0,0 +1,242 @@
+import math
+import os
+import threading
+import time
+from collections import Counter
+from http import HTTPStatus
+
+from flask import abort, g, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import import_string
+
+from lru import LRUCache
+
+# endpoint=rate/burst, rate in requests per second per client IP. "*" applies
+# to the endpoints not listed.
+DEFAULT_RATE_LIMITS = ("search_questions=10/50,get_quizzes=20/100,"
+                       "import_questions=1/5,export_questions=1/5")
+
+# endpoints that do not touch the database, never limited
+EXEMPT = {"static", "get_configs", "get_cache_stats", "get_pool_stats",
+          "get_limit_stats", "get_write_stats", "get_store_stats",
+          "get_metrics", "get_profiles", "get_profile"}
+
+# seconds clients are asked to wait when requests are shed
+SHED_RETRY_AFTER = 1
+
+
+def parse_limits(value):
+    """Parse ``endpoint=rate/burst`` pairs, comma separated"""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        endpoint, limit = item.split("=")
+        rate, burst = limit.split("/")
+        limits[endpoint.strip()] = (float(rate), int(burst))
+    check_limits(limits)
+    return limits
+
+
+def check_limits(limits):
+    """Raise ValueError unless every rate is positive and every burst holds
+    at least one request"""
+    for endpoint, (rate, burst) in limits.items():
+        if not rate > 0 or burst < 1:
+            raise ValueError(f"{endpoint}: rate must be positive and burst at least 1")
+
+
+def forwarded_client(remote_addr, forwarded_for, trusted_proxies):
+    """Client IP of a request, the address ``trusted_proxies`` hops from the
+    end of ``X-Forwarded-For``, like werkzeug's ProxyFix"""
+    if not trusted_proxies or not forwarded_for:
+        return remote_addr
+    hops = [hop.strip() for hop in forwarded_for.split(",")]
+    if len(hops) < trusted_proxies:
+        return remote_addr
+    return hops[-trusted_proxies]
+
+
+class MemoryBackend:
+    """Token buckets of this process, the least recently used are dropped
+    beyond ``maxsize`` clients"""
+
+    name = "memory"
+
+    def __init__(self, maxsize=100000):
+        self._buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket, return 0 or the seconds until one
+        is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets.set(key, (tokens - 1, now))
+                return 0
+            self._buckets.set(key, (tokens, now))
+        return (1 - tokens) / rate
+
+
+class RedisBackend:
+    """Token buckets shared by all processes, on a Redis compatible server.
+    Each bucket is refilled and taken from atomically by a script."""
+
+    name = "redis"
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url, prefix="trivia:ratelimit:"):
+        # optional dependency, only needed when this backend is selected
+        import redis
+
+        self._take = redis.Redis.from_url(url).register_script(self.SCRIPT)
+        self._prefix = prefix
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self._prefix + key], args=[rate, burst]))
+
+
+class Limiter:
+    """Admission control of the endpoints using the database.
+
+    A token bucket per endpoint and client IP rejects bursts with 429, and a
+    cap on the requests in flight sheds load with 503 once the database is
+    saturated. Both answer with ``Retry-After``.
+
+    Configured from ``RATE_LIMIT_BACKEND`` (``memory``, ``redis``, ``none``
+    or the import path of a class with the ``take`` method of the backends
+    above, built with the app), ``RATE_LIMITS`` (see parse_limits),
+    ``RATE_LIMIT_REDIS_URL``, ``MAX_REQUESTS_IN_FLIGHT`` (per process, 0 for
+    no cap), ``REQUEST_QUEUE_TIMEOUT``: seconds a request waits for a slot
+    before being shed, and ``TRUSTED_PROXIES``: the number of reverse proxies
+    in front of the app, whose ``X-Forwarded-For`` gives the client IP.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.limits = {}
+        self.max_in_flight = 0
+        self.queue_timeout = 0
+        self.trusted_proxies = 0
+        self._slots = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.allowed = Counter()
+        self.limited = Counter()
+        self.shed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def init_app(self, app):
+        backend = app.config.setdefault(
+            "RATE_LIMIT_BACKEND", os.environ.get("RATE_LIMIT_BACKEND", "memory"))
+        self.limits = app.config.setdefault(
+            "RATE_LIMITS", parse_limits(os.environ.get("RATE_LIMITS", DEFAULT_RATE_LIMITS)))
+        self.max_in_flight = app.config.setdefault(
+            "MAX_REQUESTS_IN_FLIGHT", int(os.environ.get("MAX_REQUESTS_IN_FLIGHT", 0)))
+        self.queue_timeout = app.config.setdefault(
+            "REQUEST_QUEUE_TIMEOUT", float(os.environ.get("REQUEST_QUEUE_TIMEOUT", 0)))
+        self.trusted_proxies = app.config.setdefault(
+            "TRUSTED_PROXIES", int(os.environ.get("TRUSTED_PROXIES", 0)))
+        check_limits(self.limits)
+        if self.trusted_proxies:
+            # request.remote_addr is the client, not the closest proxy
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for=self.trusted_proxies)
+        if backend == "memory":
+            self.backend = MemoryBackend()
+        elif backend == "redis":
+            self.backend = RedisBackend(app.config.setdefault(
+                "RATE_LIMIT_REDIS_URL",
+                os.environ.get("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")))
+        elif backend == "none":
+            self.backend = None
+        else:
+            self.backend = import_string(backend)(app)
+        self._slots = threading.BoundedSemaphore(
+            self.max_in_flight) if self.max_in_flight else None
+        self._reset()
+        app.before_request(self._admit)
+        app.teardown_request(self._release_slot)
+
+    def check_rate(self, endpoint, client):
+        """Count a request, return None when allowed or the seconds the client
+        has to wait"""
+        limit = self.limits.get(endpoint, self.limits.get("*"))
+        if self.backend is None or limit is None:
+            return None
+        wait = self.backend.take(f"{endpoint}:{client}", *limit)
+        with self._lock:
+            if wait:
+                self.limited[endpoint] += 1
+            else:
+                self.allowed[endpoint] += 1
+        return wait or None
+
+    def acquire(self, timeout=0):
+        """Take a slot for a request in flight, False when none is free"""
+        if self._slots is not None and not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.shed += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": getattr(self.backend, "name", type(self.backend).__name__)
+                if self.backend else None,
+                "allowed": dict(self.allowed),
+                "limited": dict(self.limited),
+                "shed": self.shed,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "max_in_flight": self.max_in_flight,
+            }
+
+    def _admit(self):
+        # preflight requests are answered by Flask-Cors without the view
+        if (request.endpoint is None or request.endpoint in EXEMPT
+                or request.method == "OPTIONS"):
+            return
+        wait = self.check_rate(request.endpoint, request.remote_addr)
+        if wait is not None:
+            abort(HTTPStatus.TOO_MANY_REQUESTS, retry_after=math.ceil(wait))
+        if not self.acquire(self.queue_timeout):
+            abort(HTTPStatus.SERVICE_UNAVAILABLE, retry_after=SHED_RETRY_AFTER)
+        g.limiter_slot = True
+
+    def _release_slot(self, error):
+        if g.pop("limiter_slot", False):
+            self.release()
+
+
+limiter = Limiter()
@@ -0,0 +1,191 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+
+from flask import Response, current_app, request
+
+from lru import LRUCache
+from routing import replicas
+
+
+class MemoryBackend:
+    """Process-local LRU backend with expiry"""
+
+    name = "memory"
+
+    def __init__(self, maxsize, ttl):
+        self._entries = LRUCache(maxsize, ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, value):
+        self._entries.set(key, value)
+
+    def generation(self, tag):
+        return self._generations.get(tag, 0)
+
+    def bump(self, tag):
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def evictions(self):
+        return self._entries.evictions
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Backend shared by all processes, talking to a Redis compatible server.
+
+    Bounding the size is left to the server, e.g. ``maxmemory`` together with
+    ``maxmemory-policy allkeys-lru``.
+    """
+
+    name = "redis"
+
+    def __init__(self, url, ttl, prefix="trivia:response:"):
+        # optional dependency, only needed when this backend is selected
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._ttl = ttl
+        self._prefix = prefix
+
+    def get(self, key):
+        return self._redis.get(self._prefix + key)
+
+    def set(self, key, value):
+        self._redis.set(self._prefix + key, value, ex=self._ttl)
+
+    def generation(self, tag):
+        return int(self._redis.get(f"{self._prefix}generation:{tag}") or 0)
+
+    def bump(self, tag):
+        self._redis.incr(f"{self._prefix}generation:{tag}")
+
+    def clear(self):
+        for key in self._redis.scan_iter(match=self._prefix + "*"):
+            self._redis.delete(key)
+
+    @property
+    def evictions(self):
+        return self._redis.info("stats").get("evicted_keys", 0)
+
+    def __len__(self):
+        return sum(1 for _ in self._redis.scan_iter(match=self._prefix + "*"))
+
+
+class ResponseCache:
+    """Caches successful responses of read endpoints.
+
+    Every entry is tagged, e.g. ``questions`` or ``category:1``. The current
+    generation of each tag is part of the cache key, so invalidating a tag
+    bumps its generation and makes every entry carrying it unreachable. Stale
+    entries then age out of the backend.
+
+    Configured from ``RESPONSE_CACHE_BACKEND`` (``memory``, ``redis`` or
+    ``none``), ``RESPONSE_CACHE_SIZE``, ``RESPONSE_CACHE_TTL`` and
+    ``RESPONSE_CACHE_REDIS_URL``.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        backend = app.config.setdefault(
+            "RESPONSE_CACHE_BACKEND", os.environ.get("RESPONSE_CACHE_BACKEND", "memory"))
+        size = app.config.setdefault(
+            "RESPONSE_CACHE_SIZE", int(os.environ.get("RESPONSE_CACHE_SIZE", 1024)))
+        ttl = app.config.setdefault(
+            "RESPONSE_CACHE_TTL", int(os.environ.get("RESPONSE_CACHE_TTL", 30)))
+        if backend == "memory":
+            self.backend = MemoryBackend(size, ttl)
+        elif backend == "redis":
+            self.backend = RedisBackend(app.config.setdefault(
+                "RESPONSE_CACHE_REDIS_URL",
+                os.environ.get("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")), ttl)
+        else:
+            self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, view, *tags):
+        """Wrap ``view`` so its successful responses are cached under ``tags``.
+        Tags are formatted with the view arguments, e.g. ``category:{category_id}``."""
+
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            # pinned after a write, the client must not get a page read from
+            # a lagging replica by another client, nor fill the cache
+            if self.backend is None or replicas.reads_pinned_to_primary():
+                return view(**kwargs)
+            key = self._key([tag.format(**kwargs) for tag in tags])
+            entry = self.backend.get(key)
+            with self._lock:
+                if entry is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if entry is not None:
+                return self._load(entry)
+            response = current_app.make_response(view(**kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                self.backend.set(key, self._dump(response))
+            return response
+
+        return wrapper
+
+    def invalidate(self, *tags):
+        """Make every entry carrying one of ``tags`` unreachable"""
+        if self.backend is not None:
+            for tag in tags:
+                self.backend.bump(tag)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        return {
+            "backend": self.backend.name if self.backend else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions if self.backend else 0,
+            "size": len(self.backend) if self.backend else 0,
+        }
+
+    def _key(self, tags):
+        generations = ",".join(
+            f"{tag}@{self.backend.generation(tag)}" for tag in tags)
+        body = hashlib.sha1(request.get_data()).hexdigest()
+        # the same URL may be served as JSON or streamed NDJSON
+        accept = request.headers.get("Accept", "")
+        return f"{request.method} {request.full_path} {accept} {body} {generations}"
+
+    @staticmethod
+    def _dump(response):
+        head = json.dumps({"status": response.status_code,
+                           "content_type": response.content_type})
+        return head.encode() + b"\n" + response.get_data()
+
+    @staticmethod
+    def _load(entry):
+        head, body = entry.split(b"\n", 1)
+        head = json.loads(head)
+        return Response(body, status=head["status"], content_type=head["content_type"])
+
+
+response_cache = ResponseCache()
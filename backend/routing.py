@@ -0,0 +1,115 @@
+import functools
+import itertools
+import os
+import threading
+import time
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+from db_pool import engine_options
+
+# cookie telling until when reads of a client go to the primary
+READ_YOUR_WRITES_COOKIE = "trivia_primary_until"
+
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class ReplicaSet:
+    """Read replicas serving the read-only views.
+
+    Configured from ``DB_REPLICA_URLS`` (comma separated),
+    ``DB_REPLICA_STRATEGY`` (``round_robin`` or ``least_connections``) and
+    ``DB_READ_YOUR_WRITES``: seconds during which a client that wrote keeps
+    reading from the primary, hiding replication lag, 0 to disable.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self.strategy = "round_robin"
+        self.read_your_writes = 0
+        self._lock = threading.Lock()
+        self._cycle = None
+
+    def init_app(self, app):
+        urls = app.config.setdefault("DATABASE_REPLICA_URIS", [
+            url for url in os.environ.get("DB_REPLICA_URLS", "").split(",") if url])
+        self.strategy = app.config.setdefault(
+            "DATABASE_REPLICA_STRATEGY", os.environ.get("DB_REPLICA_STRATEGY", "round_robin"))
+        self.read_your_writes = app.config.setdefault(
+            "DATABASE_READ_YOUR_WRITES", int(os.environ.get("DB_READ_YOUR_WRITES", 5)))
+        for engine in self.engines:
+            engine.dispose()
+        # engines connect lazily, on first use
+        self.engines = [create_engine(url, **engine_options(url)) for url in urls]
+        self._cycle = itertools.cycle(self.engines)
+        app.after_request(self._remember_write)
+
+    def pick(self):
+        """Replica engine for the next read-only request, None without replicas"""
+        if not self.engines:
+            return None
+        if self.strategy == "least_connections":
+            return min(self.engines, key=lambda engine: engine.pool.checkedout()
+                       if hasattr(engine.pool, "checkedout") else 0)
+        with self._lock:
+            return next(self._cycle)
+
+    def reads_pinned_to_primary(self):
+        try:
+            return float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def _remember_write(self, response):
+        if (self.engines and self.read_your_writes
+                and request.method in WRITE_METHODS
+                and not g.get("read_only") and response.status_code < 400):
+            response.set_cookie(
+                READ_YOUR_WRITES_COOKIE, str(time.time() + self.read_your_writes),
+                max_age=self.read_your_writes, httponly=True)
+        return response
+
+
+replicas = ReplicaSet()
+
+
+def read_only(view):
+    """Mark a view as read-only, its queries may be served by a replica"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        if not replicas.reads_pinned_to_primary():
+            g.replica = replicas.pick()
+        return view(*args, **kwargs)
+
+    # looked up by cache_headers, kept by wrappers using functools.wraps
+    wrapper.read_only = True
+    return wrapper
+
+
+def is_read_only(view):
+    """Whether ``view``, or a view it wraps, is marked read_only"""
+    while view is not None:
+        if getattr(view, "read_only", False):
+            return True
+        view = getattr(view, "__wrapped__", None)
+    return False
+
+
+class RoutingSession(Session):
+    """Session sending the queries of read-only views to the replica picked
+    for the request, everything else to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # a session bound to a connection, e.g. tests running each case in a
+        # transaction rolled back afterwards, only uses that connection
+        if bind is None and self.bind is not None:
+            return self.bind
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get("replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
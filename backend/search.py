@@ -0,0 +1,76 @@
+import re
+
+from sqlalchemy import literal_column, or_
+from sqlalchemy.sql import func
+
+from models import Question, db
+from streaming import QUESTION_COLUMNS
+
+# Document searched by full-text search. The text must stay identical to the
+# expression of the GIN index questions_search_idx (see migrations/) for
+# PostgreSQL to use the index.
+SEARCH_DOCUMENT = literal_column(
+    "to_tsvector('english'::regconfig, "
+    "coalesce(questions.question, '') || ' ' || coalesce(questions.answer, ''))"
+)
+
+WORD = re.compile(r"\w+")
+
+
+def _prefix_query(term):
+    """Build a tsquery matching every word of the term as a prefix, None if
+    the term contains no word"""
+    words = WORD.findall(term)
+    if not words:
+        return None
+    return func.to_tsquery(
+        literal_column("'english'::regconfig"),
+        " & ".join(f"{word}:*" for word in words),
+    )
+
+
+def page_number(value):
+    """``page`` of a search request body, at least 1, None when it is not an
+    integer"""
+    # JSON true is not a page number
+    if isinstance(value, bool):
+        return None
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return None
+
+
+def search_criteria(term, dialect=None):
+    """Condition matching ``term`` and the ordering of the matches, best
+    first. PostgreSQL uses the full-text index, other databases and terms
+    without any word fall back to substring matching."""
+    tsquery = _prefix_query(term)
+    dialect = dialect or db.engine.dialect.name
+    if tsquery is not None and dialect == "postgresql":
+        condition = SEARCH_DOCUMENT.op("@@")(tsquery)
+        order_by = (func.ts_rank_cd(SEARCH_DOCUMENT, tsquery).desc(), Question.id)
+    else:
+        condition = or_(Question.question.ilike(f"%{term}%"),
+                        Question.answer.ilike(f"%{term}%"))
+        order_by = (Question.id,)
+    return condition, order_by
+
+
+def search_questions(term, page, per_page):
+    """Search questions and answers for ``term``.
+
+    Returns the requested page of matching question rows (the columns of
+    streaming.QUESTION_COLUMNS), best matches first, and the total number of
+    matches.
+    """
+    condition, order_by = search_criteria(term)
+    questions = (
+        db.session.query(*QUESTION_COLUMNS).filter(condition)
+        .order_by(*order_by)
+        .offset((page - 1) * per_page)
+        .limit(per_page)
+        .all()
+    )
+    total = db.session.query(func.count(Question.id)).filter(condition).scalar()
+    return questions, total
@@ -0,0 +1,75 @@
+"""Fast JSON encoding of question listings.
+
+Listings select the question columns into plain rows instead of hydrating ORM
+instances and calling ``format()``. With orjson (in requirements.txt), each
+question is encoded once, its JSON bytes are cached per id and spliced into
+the response body. Without it, splicing costs more than it saves and the
+listing is encoded at once by the stdlib encoder. Either way the bytes are
+those of jsonify, non-ASCII characters included.
+"""
+import json
+import os
+
+from flask import Response
+
+from lru import LRUCache
+
+try:
+    import orjson
+except ImportError:  # optional dependency, the stdlib encoder is the fallback
+    orjson = None
+
+# encoded questions kept in memory
+QUESTION_JSON_CACHE_SIZE = int(os.environ.get("QUESTION_JSON_CACHE_SIZE", 100000))
+
+# seconds before a cached question is encoded again, to pick up updates made
+# by other processes
+QUESTION_JSON_CACHE_TTL = int(os.environ.get("QUESTION_JSON_CACHE_TTL", 60))
+
+_questions = LRUCache(QUESTION_JSON_CACHE_SIZE, QUESTION_JSON_CACHE_TTL)
+
+
+def dumps(value):
+    """JSON bytes of ``value``, compact with sorted keys like jsonify"""
+    if orjson is not None:
+        encoded = orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        # orjson writes non-ASCII characters as UTF-8, jsonify escapes them
+        if encoded.isascii():
+            return encoded
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode()
+
+
+def question_json(row):
+    """JSON bytes of a question row selected with streaming.QUESTION_COLUMNS,
+    the same object as Question.format()"""
+    encoded = _questions.get(row.id)
+    if encoded is None:
+        encoded = dumps(row._asdict())
+        _questions.set(row.id, encoded)
+    return encoded
+
+
+def invalidate(*question_ids):
+    """Forget the encoding of updated or deleted questions"""
+    for question_id in question_ids:
+        _questions.pop(question_id)
+
+
+def clear():
+    _questions.clear()
+
+
+def render(body, questions):
+    """JSON bytes of ``body`` with the question rows listed under its
+    ``questions`` key, encoded like jsonify"""
+    if orjson is None:
+        return dumps(dict(body, questions=[row._asdict() for row in questions])) + b"\n"
+    encoded = {key: dumps(value) for key, value in body.items()}
+    encoded["questions"] = b"[" + b",".join(map(question_json, questions)) + b"]"
+    return b"{" + b",".join(
+        dumps(key) + b":" + encoded[key] for key in sorted(encoded)) + b"}\n"
+
+
+def json_response(body, questions):
+    """Flask response of render()"""
+    return Response(render(body, questions), mimetype="application/json")
@@ -0,0 +1,43 @@
+from flask import Response, request, stream_with_context
+
+from models import Question, db
+import serialization
+
+NDJSON = "application/x-ndjson"
+
+# rows fetched per round trip from the server-side cursor
+STREAM_BATCH_SIZE = 1000
+
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+
+
+def wants_ndjson():
+    """Whether the client asked for a streamed NDJSON response, with
+    ``Accept: application/x-ndjson`` or the ``stream`` query flag"""
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return True
+    return request.accept_mimetypes.best_match(
+        ["application/json", NDJSON]) == NDJSON
+
+
+def question_rows(*criteria, order_by=(Question.id,)):
+    """Query the columns of questions matching ``criteria``, fetched in
+    batches from a server-side cursor"""
+    return (
+        db.session.query(*QUESTION_COLUMNS)
+        .filter(*criteria)
+        .order_by(*order_by)
+        .execution_options(stream_results=True)
+        .yield_per(STREAM_BATCH_SIZE)
+    )
+
+
+def ndjson_response(rows):
+    """Stream rows as newline delimited JSON, one object per row"""
+
+    def generate():
+        for row in rows:
+            yield serialization.dumps(row._asdict()) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
@@ -1,35 +1,70 @@
+import importlib.util
 import os
 import unittest
+from concurrent.futures import Future
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
+import gzip
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import Question, QuestionCount, Category, db
+from sqlalchemy import event, text
+import streaming
+import tempfile
+import threading
+from category_cache import category_cache
+from question_index import QuestionIndex, question_index
+from profiling import explain, profiler
+from question_store import Columns, StoredQuestion, question_store
+from rate_limit import forwarded_client, limiter, parse_limits
+from response_cache import response_cache
+from routing import RoutingSession, replicas
+from write_behind import write_behind
+import serialization
 import time
 import math
 import random
-from flask import jsonify
+from flask import Flask, jsonify
+from werkzeug.exceptions import ServiceUnavailable
 
 
 class TestTriviaAPI(unittest.TestCase):
     """This class represents the trivia test case"""
 
-    def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}:{}@{}/{}".format(
-            "student", "student", "localhost:5432", self.database_name
+    @classmethod
+    def setUpClass(cls):
+        """Create the app once, for every test"""
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgresql://{}:{}@{}/{}".format(
+            "student", "student", "localhost:5432", cls.database_name
         )
-        setup_db(self.app, self.database_path)
+        # the tables are created by trivia.psql
+        cls.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": cls.database_path,
+            "DATABASE_CREATE_ALL": False,
+            "RATE_LIMIT_BACKEND": "none",
+        })
 
-        # binds the app to the current context
+    def setUp(self):
+        """Run each test in a transaction rolled back by tearDown. Sessions
+        are bound to its connection, their commits and rollbacks end a
+        savepoint that is started again."""
+        self.client = self.app.test_client
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        db.session.session_factory.configure(bind=self.connection)
+        event.listen(RoutingSession, "after_transaction_end", self.restart_savepoint)
+        # state kept by the process would outlive the rolled back rows
+        category_cache.invalidate()
+        question_index.invalidate()
+        response_cache.clear()
+        serialization.clear()
+
+    def restart_savepoint(self, session, transaction):
+        if not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
 
     def test_get_categories(self):
         """Test GET /categories endpoint"""
@@ -37,6 +72,15 @@ class TestTriviaAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertNotEqual(response.json["categories"], None)
 
+    def test_get_categories_not_modified(self):
+        """Test GET /categories endpoint with If-None-Match"""
+        response = self.client().get("/categories")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        response = self.client().get(
+            "/categories", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
     def test_get_categories_invalid_format(self):
         """Test GET /categories endpoint"""
         response = self.client().get("/categories/12")
@@ -72,6 +116,19 @@ class TestTriviaAPI(unittest.TestCase):
             self.assertEqual(
                 response.json["questions"], totalQuestions)
 
+    def test_get_questions_after_id(self):
+        """Test GET /questions?after_id=<question_id> endpoint"""
+        response = self.client().get("/questions?page=1")
+        self.assertEqual(response.status_code, 200)
+        first_page = [item["id"] for item in response.json["questions"]]
+        # keyset page starting after the first question equals the offset page shifted by one
+        response = self.client().get(f"/questions?after_id={first_page[0]}")
+        self.assertEqual(response.status_code, 200)
+        after_page = [item["id"] for item in response.json["questions"]]
+        self.assertEqual(after_page[:len(first_page) - 1], first_page[1:])
+        self.assertTrue(all(id > first_page[0] for id in after_page))
+        self.assertIn("next_after_id", response.json)
+
     def test_create_question_success(self):
         """Test POST /questions endpoint with happy path test data"""
         unique_str = str(time.time_ns())
@@ -91,6 +148,45 @@ class TestTriviaAPI(unittest.TestCase):
         response = self.client().post("/questions", json=new_question)
         self.assertEqual(response.status_code, 404)
 
+    def test_bulk_import_questions(self):
+        """Test POST /questions/bulk endpoint with NDJSON and CSV bodies"""
+        unique_str = str(time.time_ns())
+        rows = [json.dumps({"question": f"bulk {unique_str} {i}", "answer": "answer",
+                            "difficulty": 1, "category": 2}) for i in range(3)]
+        rows.append(json.dumps({"question": "bulk", "answer": "answer",
+                                "difficulty": 1, "category": 100000000}))
+        rows.append(json.dumps([{"question": "bulk", "answer": "answer"}]))
+        response = self.client().post("/questions/bulk", data="\n".join(rows),
+                                      content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["inserted"], 3)
+        self.assertEqual(response.json["error_count"], 2)
+        self.assertEqual(response.json["errors"][0]["line"], 4)
+        self.assertEqual(response.json["errors"][1],
+                         {"line": 5, "error": "expected a JSON object"})
+
+        csv_body = f"question,answer,difficulty,category\nbulk {unique_str},answer,2,2\n"
+        response = self.client().post("/questions/bulk", data=csv_body,
+                                      content_type="text/csv")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["inserted"], 1)
+
+    def test_bulk_import_questions_unsupported_type(self):
+        """Test POST /questions/bulk endpoint with unsupported content type"""
+        response = self.client().post("/questions/bulk", data="question",
+                                      content_type="text/plain")
+        self.assertEqual(response.status_code, 415)
+
+    def test_export_questions(self):
+        """Test GET /questions/export endpoint"""
+        response = self.client().get("/questions/export")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        exported = [json.loads(line) for line in response.data.splitlines()]
+        total_questions = self.client().get(
+            "/questions").json["total_questions"]
+        self.assertEqual(len(exported), total_questions)
+
     def test_get_question_by_category_success(self):
         """Test GET /categories/<category_id>/questions endpoint"""
         response = self.client().get("/categories/1/questions")
@@ -98,6 +194,18 @@ class TestTriviaAPI(unittest.TestCase):
         self.assertEqual(
             len(response.json["questions"]), response.json["total_questions"])
 
+    def test_get_question_by_category_streamed(self):
+        """Test GET /categories/<category_id>/questions endpoint streaming NDJSON"""
+        total_questions = self.client().get(
+            "/categories/1/questions").json["total_questions"]
+        response = self.client().get("/categories/1/questions",
+                                     headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        questions = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(len(questions), total_questions)
+        self.assertTrue(all(item["category"] == 1 for item in questions))
+
     def test_get_question_of_invalid_category(self):
         """Test GET /categories/<category_id>/questions endpoint"""
         response = self.client().get("/categories/fff/questions")
@@ -115,11 +223,128 @@ class TestTriviaAPI(unittest.TestCase):
             f"/questions/{created_question_id}")
         self.assertEqual(delete_response.status_code, 204)
 
+    def test_question_listing_matches_format(self):
+        """Test GET /questions encodes the same objects as Question.format()"""
+        response = self.client().get("/questions")
+        with self.app.app_context():
+            expected = [item.format() for item in Question.query.order_by(Question.id).limit(10)]
+        self.assertEqual(response.json["questions"], expected)
+
+    def test_get_questions_compressed_and_conditional(self):
+        """Test GET /questions is gzipped and answered with 304 when unchanged"""
+        response = self.client().get("/questions", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertIn("no-cache", response.headers["Cache-Control"])
+        self.assertEqual(json.loads(gzip.decompress(response.data))["questions"],
+                         self.client().get("/questions").json["questions"])
+        response = self.client().get("/questions", headers={
+            "Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_preflight_max_age(self):
+        """Test OPTIONS preflight responses can be cached by browsers"""
+        response = self.client().options("/questions", headers={
+            "Origin": "http://localhost:3000", "Access-Control-Request-Method": "POST"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Access-Control-Max-Age"], "600")
+
+    def test_get_stats(self):
+        """Test GET /stats endpoint follows created and deleted questions"""
+        response = self.client().get("/stats")
+        self.assertEqual(response.status_code, 200)
+        stats = response.json
+        self.assertEqual(stats["total_questions"],
+                         self.client().get("/questions").json["total_questions"])
+        self.assertEqual(stats["categories"]["1"]["total_questions"],
+                         len(self.client().get("/categories/1/questions").json["questions"]))
+        response = self.client().post("/questions", json={"question": f"question {str(time.time_ns())}",
+                                                          "answer": "answer", "difficulty": 5, "category": 1})
+        self.assertEqual(response.status_code, 201)
+        created = self.client().get("/stats").json
+        self.assertEqual(created["total_questions"], stats["total_questions"] + 1)
+        self.assertEqual(created["categories"]["1"]["difficulties"]["5"],
+                         stats["categories"]["1"]["difficulties"].get("5", 0) + 1)
+        self.client().delete(f"/questions/{response.json['question']['id']}")
+        self.assertEqual(self.client().get("/stats").json, stats)
+
+    def test_stats_follow_deleted_category(self):
+        """Test GET /stats counts the questions of a deleted category as unknown"""
+        with self.app.app_context():
+            category = Category("deleted")
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+        category_cache.invalidate()
+        response = self.client().post("/questions", json={"question": f"question {time.time_ns()}",
+                                                          "answer": "answer", "difficulty": 3,
+                                                          "category": category_id})
+        self.assertEqual(response.status_code, 201)
+        stats = self.client().get("/stats").json
+        unknown = stats["categories"].get("0", {"difficulties": {}})["difficulties"].get("3", 0)
+        # deleted around the application, the foreign key sets the question's category to NULL
+        with self.app.app_context():
+            db.session.execute(Category.__table__.delete().where(Category.id == category_id))
+            db.session.commit()
+        response_cache.clear()
+        deleted = self.client().get("/stats").json
+        self.assertNotIn(str(category_id), deleted["categories"])
+        self.assertEqual(deleted["categories"]["0"]["difficulties"]["3"], unknown + 1)
+        self.assertEqual(deleted["total_questions"], stats["total_questions"])
+
     def test_delete_question_with_incorrect_id(self):
         """Test DELETE /questions/<question_id> endpoint with incorrect question id"""
         delete_response = self.client().delete("/questions/111111111111111111111111")
         self.assertEqual(delete_response.status_code, 404)
 
+    def test_delete_questions_batch(self):
+        """Test DELETE /questions endpoint with an id list"""
+        ids = [self.client().post("/questions", json={
+            "question": f"question {time.time_ns()}", "answer": "answer",
+            "difficulty": 2, "category": 1}).json["question"]["id"] for _ in range(3)]
+        total = self.client().get("/stats").json["total_questions"]
+        response = self.client().delete("/questions", json={"ids": ids + [111111111]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["deleted"], ids)
+        self.assertEqual(self.client().get("/stats").json["total_questions"], total - 3)
+        response = self.client().delete("/questions", json={"ids": []})
+        self.assertEqual(response.status_code, 422)
+        # a body that is not an object
+        for body in ([1, 2], 1, "ids"):
+            self.assertEqual(self.client().delete("/questions", json=body).status_code, 422)
+
+    def test_update_questions_batch(self):
+        """Test PATCH /questions endpoint with partial updates"""
+        ids = [self.client().post("/questions", json={
+            "question": f"question {time.time_ns()}", "answer": "answer",
+            "difficulty": 2, "category": 1}).json["question"]["id"] for _ in range(2)]
+        stats = self.client().get("/stats").json
+        response = self.client().patch("/questions", json={"questions": [
+            {"id": ids[0], "answer": "new answer"},
+            {"id": ids[1], "difficulty": 5, "category": 2}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["updated"], ids)
+        questions = {item["id"]: item for item in self.client().get(
+            "/categories/1/questions").json["questions"]}
+        self.assertEqual(questions[ids[0]]["answer"], "new answer")
+        self.assertNotIn(ids[1], questions)
+        updated = self.client().get("/stats").json
+        self.assertEqual(updated["categories"]["2"]["difficulties"]["5"],
+                         stats["categories"]["2"]["difficulties"].get("5", 0) + 1)
+        self.assertEqual(updated["total_questions"], stats["total_questions"])
+
+    def test_update_questions_batch_invalid(self):
+        """Test PATCH /questions endpoint with an invalid update"""
+        response = self.client().patch("/questions", json={"questions": [
+            {"id": 1, "difficulty": 9}]})
+        self.assertEqual(response.status_code, 422)
+        response = self.client().patch("/questions", json={"questions": [
+            {"id": 1, "category": 100000000}]})
+        self.assertEqual(response.status_code, 422)
+        for body in ([{"id": 1, "answer": "answer"}], 1, "questions"):
+            self.assertEqual(self.client().patch("/questions", json=body).status_code, 422)
+
     def test_search_question_success(self):
         """Test POST /questions/search"""
         response = self.client().post("/questions/search",
@@ -133,6 +358,93 @@ class TestTriviaAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json["total_questions"], 0)
 
+    def test_search_question_answer_and_pagination(self):
+        """Test POST /questions/search matches answers and paginates"""
+        unique_str = str(time.time_ns())
+        for _ in range(11):
+            response = self.client().post("/questions", json={"question": "question",
+                                                              "answer": f"answer{unique_str}", "difficulty": 1, "category": 1})
+            self.assertEqual(response.status_code, 201)
+        response = self.client().post("/questions/search",
+                                      json={"searchTerm": f"answer{unique_str}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["total_questions"], 11)
+        self.assertEqual(len(response.json["questions"]), 10)
+        response = self.client().post("/questions/search",
+                                      json={"searchTerm": f"answer{unique_str}", "page": 2})
+        self.assertEqual(len(response.json["questions"]), 1)
+
+    def test_search_question_invalid_page(self):
+        """Test POST /questions/search with a page that is not an integer"""
+        for page in ("x", None, True):
+            response = self.client().post("/questions/search",
+                                          json={"searchTerm": "title", "page": page})
+            self.assertEqual(response.status_code, 422)
+
+    def test_response_cache_invalidated_by_create_question(self):
+        """Test GET /categories/<category_id>/questions is served from cache until a write"""
+        response = self.client().get("/categories/1/questions")
+        total_questions = response.json["total_questions"]
+        hits = self.client().get("/ops/cache").json["cache"]["hits"]
+        response = self.client().get("/categories/1/questions")
+        self.assertEqual(self.client().get(
+            "/ops/cache").json["cache"]["hits"], hits + 1)
+        self.assertEqual(response.json["total_questions"], total_questions)
+        # a new question of the category is visible right away
+        response = self.client().post("/questions", json={"question": f"question {str(time.time_ns())}",
+                                                          "answer": "answer", "difficulty": 1, "category": 1})
+        self.assertEqual(response.status_code, 201)
+        response = self.client().get("/categories/1/questions")
+        self.assertEqual(response.json["total_questions"], total_questions + 1)
+
+    def test_quizzes_whole_round(self):
+        """Test POST /quizzes with count returns distinct questions of the category"""
+        questions_per_play = self.client().get("/configs").json["configs"]["questions_per_play"]
+        response = self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": {"id": 0}, "count": questions_per_play + 10})
+        self.assertEqual(response.status_code, 200)
+        ids = [question["id"] for question in response.json["questions"]]
+        self.assertEqual(len(ids), questions_per_play)
+        self.assertEqual(len(set(ids)), len(ids))
+        response = self.client().post("/quizzes", json={
+            "previous_questions": [20], "quiz_category": {"id": 1}, "count": 2})
+        self.assertTrue(all(question["category"] == 1 and question["id"] != 20
+                            for question in response.json["questions"]))
+
+    def test_quizzes_whole_round_with_invalid_count(self):
+        """Test POST /quizzes with a count that is not a positive integer"""
+        for count in (0, "2", True):
+            response = self.client().post("/quizzes", json={
+                "previous_questions": [], "quiz_category": {"id": 0}, "count": count})
+            self.assertEqual(response.status_code, 422)
+
+    def test_quizzes_adaptive(self):
+        """Test POST /quizzes follows the answers in adaptive mode"""
+        def next_question(adaptive):
+            response = self.client().post("/quizzes", json={
+                "previous_questions": [], "quiz_category": {"id": 0},
+                "adaptive": adaptive})
+            self.assertEqual(response.status_code, 200)
+            return response.json["question"]
+
+        # a play starts with the easiest questions
+        self.assertEqual(next_question({})["difficulty"], 1)
+        self.assertEqual(next_question(
+            {"difficulty": 1, "correct": True})["difficulty"], 2)
+        self.assertEqual(next_question(
+            {"difficulty": 3, "correct": False})["difficulty"], 2)
+
+    def test_quizzes_adaptive_invalid(self):
+        """Test POST /quizzes with an invalid adaptive answer"""
+        response = self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": {"id": 0},
+            "adaptive": {"difficulty": "hard", "correct": True}})
+        self.assertEqual(response.status_code, 422)
+        response = self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": {"id": 0},
+            "adaptive": {}, "count": 5})
+        self.assertEqual(response.status_code, 422)
+
     def test_quizzes_specific_category(self):
         """Test POST /quizzes with provided category """
         # get the number of questions per play
@@ -201,9 +513,87 @@ class TestTriviaAPI(unittest.TestCase):
         else:
             self.assertEqual(questions_received, questions_per_play)
 
+    def test_quiz_session(self):
+        """Test POST /quizzes/sessions and POST /quizzes/sessions/<token>/next"""
+        response = self.client().get("/configs")
+        questions_per_play = response.json["configs"]["questions_per_play"]
+        response = self.client().post("/quizzes/sessions",
+                                      json={"quiz_category": {"type": "", "id": 1}})
+        self.assertEqual(response.status_code, 201)
+        token = response.json["token"]
+        total_questions = response.json["total_questions"]
+        self.assertLessEqual(total_questions, questions_per_play)
+
+        # play
+        received = []
+        while True:
+            response = self.client().post(f"/quizzes/sessions/{token}/next")
+            self.assertEqual(response.status_code, 200)
+            if not response.json["question"]:
+                break
+            self.assertEqual(response.json["question"]["category"], 1)
+            received.append(response.json["question"]["id"])
+        # no duplicates and nothing missing
+        self.assertEqual(len(set(received)), total_questions)
+
+    def test_quiz_session_invalid_token(self):
+        """Test POST /quizzes/sessions/<token>/next with unknown token"""
+        response = self.client().post("/quizzes/sessions/xxxxx/next")
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_metrics(self):
+        """Test GET /metrics endpoint"""
+        self.client().get("/categories/1/questions")
+        response = self.client().get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertIn(
+            'trivia_request_duration_seconds_count{method="GET",route="/categories/<int:category_id>/questions"}',
+            response.data.decode())
+        self.assertIn("trivia_db_queries_total", response.data.decode())
+
+    def test_get_pool_stats(self):
+        """Test GET /ops/pool endpoint"""
+        response = self.client().get("/ops/pool")
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.json["pool"]["checkouts"], 0)
+        self.assertGreaterEqual(response.json["pool"]["checked_out"], 0)
+
+    def test_get_profiles_without_token(self):
+        """Test GET /debug/profiles is not served without a token configured"""
+        response = self.client().get("/debug/profiles")
+        self.assertEqual(response.status_code, 404)
+
+    def explain(self, query):
+        """EXPLAIN output of a query, with sequential scans discouraged so the
+        plan does not depend on the size of the test data"""
+        statement = query.statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = "\n".join(row[0] for row in db.session.execute(
+            text(f"EXPLAIN {statement}")))
+        db.session.rollback()
+        return plan
+
+    def test_hot_queries_use_indexes(self):
+        """Test category and difficulty filters are served by the indexes"""
+        with self.app.app_context():
+            # GET /categories/<category_id>/questions
+            plan = self.explain(Question.query.filter(
+                Question.category == 1).order_by(Question.id))
+            self.assertIn("questions_category_id_idx", plan)
+            # streamed category listing
+            plan = self.explain(streaming.question_rows(Question.category == 1))
+            self.assertIn("questions_category_id_idx", plan)
+            plan = self.explain(Question.query.filter(Question.difficulty == 3))
+            self.assertIn("questions_difficulty_idx", plan)
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        event.remove(RoutingSession, "after_transaction_end", self.restart_savepoint)
+        db.session.session_factory.configure(bind=None)
+        self.transaction.rollback()
+        self.connection.close()
 
     """
     TODO
@@ -211,6 +601,639 @@ class TestTriviaAPI(unittest.TestCase):
     """
 
 
+class TestReadReplicaRouting(unittest.TestCase):
+    """Read/write routing, with SQLite files standing in for the primary and
+    the replica so no replication is needed"""
+
+    response_cache_backend = "none"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        primary = f"sqlite:///{self.directory.name}/primary.db"
+        replica = f"sqlite:///{self.directory.name}/replica.db"
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": primary,
+            "DATABASE_REPLICA_URIS": [replica],
+            "RESPONSE_CACHE_BACKEND": self.response_cache_backend,
+        })
+        self.client = self.app.test_client
+        category_cache.invalidate()
+        question_index.invalidate()
+        serialization.clear()
+        with self.app.app_context():
+            db.create_all()
+            db.metadata.create_all(replicas.engines[0])
+            db.session.add(Category("Science"))
+            db.session.commit()
+            # the replica holds two questions the primary does not have
+            with replicas.engines[0].begin() as connection:
+                connection.execute(Category.__table__.insert(), {"type": "Science"})
+                connection.execute(Question.__table__.insert(), [
+                    {"question": "question", "answer": "answer", "difficulty": 1, "category": 1}] * 2)
+                connection.execute(QuestionCount.__table__.insert(),
+                                   {"category": 1, "difficulty": 1, "count": 2})
+
+    def test_reads_go_to_replica(self):
+        """Test read-only views are served by the replica"""
+        response = self.client().get("/questions")
+        self.assertEqual(response.json["total_questions"], 2)
+
+    def test_writes_go_to_primary_and_are_read_back(self):
+        """Test writes reach the primary and the writer then reads from it"""
+        client = self.client()
+        response = client.post("/questions", json={"question": "question", "answer": "answer",
+                                                   "difficulty": 1, "category": 1})
+        self.assertEqual(response.status_code, 201)
+        # read-your-writes cookie pins this client to the primary
+        self.assertEqual(client.get("/questions").json["total_questions"], 1)
+        # other clients keep reading from the replica
+        self.assertEqual(self.client().get(
+            "/questions").json["total_questions"], 2)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        for engine in replicas.engines:
+            engine.dispose()
+        self.directory.cleanup()
+        category_cache.invalidate()
+        question_index.invalidate()
+        serialization.clear()
+
+
+class TestReadReplicaRoutingCached(TestReadReplicaRouting):
+    """Read/write routing with the response cache"""
+
+    response_cache_backend = "memory"
+
+    def test_writer_not_served_replica_pages_cached_after_write(self):
+        """Test a page read from the replica after a write is not served to
+        the writer"""
+        client = self.client()
+        client.post("/questions", json={"question": "question", "answer": "answer",
+                                        "difficulty": 1, "category": 1})
+        # cached under the generation bumped by the write
+        self.assertEqual(self.client().get("/questions").json["total_questions"], 2)
+        self.assertEqual(self.client().get("/ops/cache").json["cache"]["size"], 1)
+        self.assertEqual(client.get("/questions").json["total_questions"], 1)
+        self.assertEqual(self.client().get("/ops/cache").json["cache"]["size"], 1)
+
+
+class SQLiteTestCase(unittest.TestCase):
+    """App on an SQLite database of its own, created with ``config`` and
+    without response cache nor rate limits"""
+
+    config = {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_path = f"{self.directory.name}/trivia.db"
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{self.database_path}",
+            "RESPONSE_CACHE_BACKEND": "none",
+            "RATE_LIMIT_BACKEND": "none",
+            **self.app_config(),
+        })
+        self.client = self.app.test_client
+        category_cache.invalidate()
+        question_index.invalidate()
+        serialization.clear()
+
+    def app_config(self):
+        """``config``, with paths in the temporary directory when needed"""
+        return self.config
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.directory.cleanup()
+        category_cache.invalidate()
+        question_index.invalidate()
+
+
+class TestAdmissionControl(SQLiteTestCase):
+    """Rate limiting and load shedding, on an SQLite database"""
+
+    config = {
+        "RATE_LIMIT_BACKEND": "memory",
+        "RATE_LIMITS": {"get_questions": (1, 2)},
+        "MAX_REQUESTS_IN_FLIGHT": 1,
+    }
+
+    def test_rate_limited_with_retry_after(self):
+        """Test requests beyond the burst of a route are answered with 429"""
+        self.assertEqual(self.client().get("/questions").status_code, 200)
+        self.assertEqual(self.client().get("/questions").status_code, 200)
+        response = self.client().get("/questions")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        # other routes have their own buckets
+        self.assertEqual(self.client().get("/categories").status_code, 200)
+        stats = self.client().get("/ops/limits").json["limits"]
+        self.assertEqual(stats["limited"], {"get_questions": 1})
+
+    def test_shed_when_too_many_in_flight(self):
+        """Test requests are answered with 503 while every slot is taken"""
+        self.assertTrue(limiter.acquire())
+        try:
+            response = self.client().get("/categories")
+            self.assertEqual(response.status_code, 503)
+            self.assertIn("Retry-After", response.headers)
+            # routes not using the database are not limited
+            self.assertEqual(self.client().get("/configs").status_code, 200)
+        finally:
+            limiter.release()
+        self.assertEqual(self.client().get("/categories").status_code, 200)
+        self.assertEqual(self.client().get("/ops/limits").json["limits"]["shed"], 1)
+
+    def test_no_retry_after_when_not_given(self):
+        """Test a 503 aborted without retry_after has no Retry-After header"""
+        with self.app.test_request_context():
+            response = self.app.make_response(
+                self.app.handle_user_exception(ServiceUnavailable()))
+        self.assertEqual(response.status_code, 503)
+        self.assertNotIn("Retry-After", response.headers)
+
+    def test_zero_rate_rejected(self):
+        """Test a limit without a positive rate or a burst is refused"""
+        for value in ("get_questions=0/5", "get_questions=-1/5", "get_questions=1/0"):
+            with self.assertRaises(ValueError):
+                parse_limits(value)
+        with self.assertRaises(ValueError):
+            create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{self.database_path}",
+                        "RATE_LIMITS": {"get_questions": (0, 2)}})
+
+    def test_forwarded_for_ignored_without_trusted_proxies(self):
+        """Test clients cannot pick their own bucket with X-Forwarded-For"""
+        for client in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+            response = self.client().get("/questions", headers={"X-Forwarded-For": client})
+        self.assertEqual(response.status_code, 429)
+
+
+class TestAdmissionControlBehindProxy(SQLiteTestCase):
+    """Rate limiting behind one reverse proxy, on an SQLite database"""
+
+    config = {
+        "RATE_LIMIT_BACKEND": "memory",
+        "RATE_LIMITS": {"get_questions": (1, 1)},
+        "TRUSTED_PROXIES": 1,
+    }
+
+    def test_limited_per_forwarded_client(self):
+        """Test the bucket is the one of the client the proxy forwards"""
+        get = self.client().get
+        self.assertEqual(get("/questions", headers={"X-Forwarded-For": "10.0.0.1"}).status_code, 200)
+        self.assertEqual(get("/questions", headers={"X-Forwarded-For": "10.0.0.2"}).status_code, 200)
+        # the hops added by the client before the proxy are not trusted
+        response = get("/questions", headers={"X-Forwarded-For": "10.0.0.3, 10.0.0.1"})
+        self.assertEqual(response.status_code, 429)
+
+    def test_forwarded_client(self):
+        """Test the client IP of the async handlers is picked like ProxyFix"""
+        self.assertEqual(forwarded_client("127.0.0.1", "10.0.0.3, 10.0.0.1", 1), "10.0.0.1")
+        self.assertEqual(forwarded_client("127.0.0.1", "10.0.0.3, 10.0.0.1", 2), "10.0.0.3")
+        self.assertEqual(forwarded_client("127.0.0.1", "10.0.0.1", 2), "127.0.0.1")
+        self.assertEqual(forwarded_client("127.0.0.1", None, 1), "127.0.0.1")
+        self.assertEqual(forwarded_client("127.0.0.1", "10.0.0.1", 0), "127.0.0.1")
+
+
+class TestStartup(unittest.TestCase):
+    """Creating the app without the database"""
+
+    def test_create_app_does_not_connect(self):
+        """Test the database is first connected by a request using it"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:////nonexistent/trivia.db",
+            "DATABASE_CREATE_ALL": False,
+            "RESPONSE_CACHE_BACKEND": "none",
+            "RATE_LIMIT_BACKEND": "none",
+        })
+        response = app.test_client().get("/configs")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["configs"]["questions_per_play"], 5)
+
+
+class TestWriteBehind(SQLiteTestCase):
+    """Group commit of created questions, on an SQLite database"""
+
+    config = {"WRITE_BEHIND": True}
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(Category("Science"))
+            db.session.commit()
+
+    def test_created_questions_committed_by_write_behind(self):
+        """Test POST /questions answers once the question is committed"""
+        before = write_behind.stats()
+        for _ in range(2):
+            response = self.client().post("/questions", json={
+                "question": "question", "answer": "answer", "difficulty": 1, "category": 1})
+            self.assertEqual(response.status_code, 201)
+            self.assertIsNotNone(response.json["question"]["id"])
+        self.assertEqual(self.client().get("/stats").json["total_questions"], 2)
+        writes = self.client().get("/ops/writes").json["writes"]
+        self.assertEqual(writes["flushed"] - before["flushed"], 2)
+        self.assertEqual(writes["failed"], before["failed"])
+        self.assertGreater(writes["max_wait_seconds"], 0)
+
+    def test_failed_batch_retried_one_by_one(self):
+        """Test a bad question only fails its own request of a batch"""
+        before = write_behind.stats()
+        batch = [(time.perf_counter(), question, Future()) for question in (
+            {"question": "good", "answer": "answer", "difficulty": 1, "category": 1},
+            {"question": "bad", "answer": "answer", "difficulty": 1, "rating": 5},
+            {"question": "also good", "answer": "answer", "difficulty": 2, "category": 1})]
+        with self.assertLogs(self.app.logger, "ERROR"):
+            write_behind._flush(batch)
+        self.assertEqual(batch[0][2].result(0)["question"], "good")
+        self.assertIsInstance(batch[1][2].exception(0), TypeError)
+        self.assertEqual(batch[2][2].result(0)["question"], "also good")
+        stats = write_behind.stats()
+        self.assertEqual(stats["flushed"] - before["flushed"], 2)
+        self.assertEqual(stats["failed"] - before["failed"], 1)
+        self.assertEqual(self.client().get("/stats").json["total_questions"], 2)
+
+    def test_bookkeeping_error_still_answers(self):
+        """Test a committed question is answered when updating caches fails"""
+        with mock.patch.object(response_cache, "invalidate", side_effect=RuntimeError), \
+                self.assertLogs(self.app.logger, "ERROR"):
+            response = self.client().post("/questions", json={
+                "question": "question", "answer": "answer", "difficulty": 1, "category": 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client().get("/stats").json["total_questions"], 1)
+
+    def test_unanswered_after_timeout(self):
+        """Test a request waits at most WRITE_BEHIND_TIMEOUT for its commit"""
+        write_behind.timeout = 0.05
+        # batches taken by the writer and never committed
+        with mock.patch.object(write_behind, "_flush"):
+            response = self.client().post("/questions", json={
+                "question": "question", "answer": "answer", "difficulty": 1, "category": 1})
+        self.assertEqual(response.status_code, 503)
+
+    def tearDown(self):
+        write_behind.enabled = False
+        super().tearDown()
+
+
+class TestQuestionStore(SQLiteTestCase):
+    """Listings served from the in-process question store, on an SQLite database"""
+
+    config = {
+        "METRICS_SERVER_TIMING": True,
+        "QUESTION_STORE": True,
+        "QUESTION_STORE_RESYNC": 3600,
+    }
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(Category("Science"))
+            db.session.add_all([Question(f"question {i}", "answer", 1, i % 5 + 1)
+                                for i in range(3)])
+            db.session.commit()
+            question_store.resync()
+
+    def test_listings_served_from_store(self):
+        """Test listings are answered without querying the database"""
+        # categories are cached by the first request
+        self.client().get("/categories")
+        for path in ("/questions", "/categories/1/questions"):
+            response = self.client().get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["total_questions"], 3)
+            self.assertEqual([question["question"] for question in response.json["questions"]],
+                             ["question 0", "question 1", "question 2"])
+            self.assertIn('desc="0 queries"', response.headers["Server-Timing"])
+        store = self.client().get("/ops/store").json["store"]
+        self.assertEqual(store["questions"], 3)
+        self.assertGreater(store["bytes"], 0)
+
+    def test_writes_applied_to_store(self):
+        """Test questions created, updated and deleted are seen at once"""
+        response = self.client().post("/questions", json={
+            "question": "new", "answer": "answer", "difficulty": 1, "category": 1})
+        question_id = response.json["question"]["id"]
+        self.client().patch("/questions", json={
+            "questions": [{"id": question_id, "answer": "updated"}]})
+        questions = self.client().get("/categories/1/questions").json["questions"]
+        self.assertEqual(questions[-1]["answer"], "updated")
+        self.client().delete(f"/questions/{question_id}")
+        response = self.client().get("/questions")
+        self.assertEqual(response.json["total_questions"], 3)
+        self.assertNotIn(question_id, [question["id"] for question in response.json["questions"]])
+
+    def test_notified_writes_applied(self):
+        """Test writes of other processes are applied once notified"""
+        # categories and the quiz index are loaded by the first requests
+        self.client().get("/categories")
+        self.client().post("/quizzes", json={"previous_questions": [], "quiz_category": {"id": 0}})
+        with self.app.app_context():
+            db.session.get(Question, 1).category = 2
+            db.session.delete(db.session.get(Question, 2))
+            question = Question("question 3", "answer", 1, 1)
+            db.session.add(question)
+            db.session.commit()
+            question_id = question.id
+            question_store._apply([{"table": "questions", "id": id}
+                                   for id in (1, 2, question_id)])
+            # no connection left idle in transaction until the next batch
+            self.assertIsNone(db.session().get_transaction())
+        response = self.client().get("/questions")
+        self.assertEqual([question["question"] for question in response.json["questions"]],
+                         ["question 0", "question 2", "question 3"])
+        self.assertIn('desc="0 queries"', response.headers["Server-Timing"])
+        self.assertEqual(sorted(question_index.sample_many(0, 10)), [1, 3, question_id])
+        self.assertEqual(sorted(question_index.sample_many(2, 10)), [1])
+        self.assertEqual(sorted(question_index.sample_many(1, 10)), [3, question_id])
+
+    def test_writes_during_resync_kept(self):
+        """Test writes applied while a resync reads the questions are replayed"""
+        extend = Columns.extend
+
+        def write_then_extend(columns, rows):
+            # committed after the rows were read
+            with db.engine.begin() as connection:
+                connection.execute(Question.__table__.delete().where(Question.id == 1))
+                connection.execute(Question.__table__.insert(), {
+                    "id": 4, "question": "question 3", "answer": "answer",
+                    "category": 1, "difficulty": 1})
+            question_store.discard(1)
+            question_store.put(StoredQuestion(4, "question 3", "answer", 1, 1))
+            extend(columns, rows)
+
+        with self.app.app_context(), mock.patch.object(
+                Columns, "extend", write_then_extend):
+            question_store.resync()
+        response = self.client().get("/questions")
+        self.assertEqual([question["question"] for question in response.json["questions"]],
+                         ["question 1", "question 2", "question 3"])
+
+    def test_resync_loads_missed_writes(self):
+        """Test a resync replaces the store with the questions of the database"""
+        with self.app.app_context():
+            db.session.delete(db.session.get(Question, 1))
+            db.session.add(Question("question 3", "answer", 1, 1))
+            db.session.commit()
+            question_store.resync()
+        response = self.client().get("/questions")
+        self.assertEqual(response.json["total_questions"], 3)
+        self.assertEqual([question["question"] for question in response.json["questions"]],
+                         ["question 1", "question 2", "question 3"])
+
+
+class TestQuestionIndex(unittest.TestCase):
+    """Quiz index reloads, from a source instead of the database"""
+
+    def test_sampled_while_reloading(self):
+        """Test the previous index is used while the rows are read, and the
+        writes made meanwhile are kept"""
+        index = QuestionIndex(ttl=0)
+        index.load([(1, 1, 1), (2, 1, 1)])
+        reading, read = threading.Event(), threading.Event()
+
+        def source():
+            reading.set()
+            read.wait(5)
+            return [(1, 1, 1), (3, 1, 1)]
+
+        index.source = source
+        reloading = threading.Thread(target=index.sample, args=(0,))
+        reloading.start()
+        self.assertTrue(reading.wait(5))
+        self.assertEqual(sorted(index.sample_many(0, 10)), [1, 2])
+        index.add(4, 1, 2)
+        index.remove(1)
+        read.set()
+        reloading.join(5)
+        index.ttl = 3600
+        self.assertEqual(sorted(index.sample_many(0, 10)), [3, 4])
+        self.assertEqual(index.sample(1, difficulty=2), 4)
+
+    def test_removed_in_place(self):
+        """Test removed ids leave every array they were in, the others stay"""
+        rows = [(id, id % 3 + 1, id % 5 + 1) for id in range(1, 201)]
+        rows.append((201, None, None))
+        index = QuestionIndex(ttl=3600)
+        index.load(rows)
+        removed = set(random.sample(range(1, 202), 80))
+        index.remove(*list(removed)[:40])
+        for question_id in list(removed)[40:]:
+            index.remove(question_id)
+        index.remove(*removed)
+        index.add(202, 1, 1)
+        rows.append((202, 1, 1))
+        kept = [row for row in rows if row[0] not in removed]
+        self.assertEqual(sorted(index.sample_many(0, 1000)), [row[0] for row in kept])
+        for category in (1, 2, 3):
+            self.assertEqual(sorted(index.sample_many(category, 1000)),
+                             [id for id, row_category, _ in kept if row_category == category])
+        for difficulty, ids in index._difficulties[1].items():
+            self.assertEqual(sorted(ids), [id for id, row_category, row_difficulty in kept
+                                           if (row_category, row_difficulty) == (1, difficulty)])
+
+    def test_invalidated_while_reloading(self):
+        """Test rows read before an invalidation are not used"""
+        index = QuestionIndex()
+        rows = [[(1, 1, 1)], [(2, 1, 1)]]
+
+        def source():
+            if len(rows) == 2:
+                index.invalidate()
+            return rows.pop(0)
+
+        index.source = source
+        self.assertEqual(index.sample(0), 2)
+
+
+class TestSerialization(unittest.TestCase):
+    """Listings encoded from column rows"""
+
+    def test_listing_bytes_match_jsonify(self):
+        """Test listings are the bytes of jsonify, with or without orjson"""
+        app = Flask(__name__)
+        rows = [StoredQuestion(1, "Café or thé?", "It’s café", 1, 2),
+                StoredQuestion(2, "question", "answer", None, 1)]
+        body = {"total_questions": 2, "currentCategory": "Sciençe"}
+        with app.app_context():
+            expected = jsonify(dict(body, questions=[row._asdict() for row in rows])).data
+        for orjson in (serialization.orjson, None):
+            serialization.clear()
+            with mock.patch.object(serialization, "orjson", orjson):
+                self.assertEqual(serialization.render(body, rows), expected)
+                # from the cache
+                self.assertEqual(serialization.render(body, rows), expected)
+
+
+class TestProfiling(SQLiteTestCase):
+    """Profiles of slow requests and plans of slow queries, on an SQLite database"""
+
+    config = {
+        "PROFILING": True,
+        "PROFILING_SAMPLE_RATE": 1,
+        "PROFILING_SLOW_REQUEST": 0,
+        "PROFILING_SLOW_QUERY": 0,
+        "PROFILING_PLAN_INTERVAL": 0,
+        "PROFILING_MAX_FILES": 2,
+        "PROFILING_TOKEN": "secret",
+    }
+
+    def app_config(self):
+        return dict(self.config, PROFILING_DIR=f"{self.directory.name}/profiles")
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(Category("Science"))
+            db.session.add(Question("What is the title?", "answer", 1, 1))
+            db.session.commit()
+
+    def test_slow_requests_recorded(self):
+        """Test slow requests are recorded with their profile and query plans"""
+        for _ in range(3):
+            self.client().post("/questions/search", json={"searchTerm": "title"})
+        profiler.wait()
+        response = self.client().get("/debug/profiles")
+        self.assertEqual(response.status_code, 401)
+        headers = {"Authorization": "Bearer secret"}
+        profiles = self.client().get("/debug/profiles", headers=headers).json["profiles"]
+        # rotated down to PROFILING_MAX_FILES
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(profiles[0]["profiled"])
+        self.assertEqual(profiles[0]["path"], "/questions/search")
+        profile = self.client().get(
+            f"/debug/profiles/{profiles[0]['id']}", headers=headers).json["profile"]
+        self.assertIn("search_questions", profile["profile"])
+        self.assertTrue(any("LIKE" in query["statement"] and query["plan"]
+                            for query in profile["queries"]))
+        response = self.client().get("/debug/profiles/1-xxxxxxxx", headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_plan_taken_once_per_interval(self):
+        """Test a statement run again within PROFILING_PLAN_INTERVAL has no plan"""
+        profiler.plan_interval = 3600
+        for _ in range(2):
+            self.client().post("/questions/search", json={"searchTerm": "title"})
+        profiler.wait()
+        headers = {"Authorization": "Bearer secret"}
+        plans = []
+        for summary in self.client().get("/debug/profiles", headers=headers).json["profiles"]:
+            profile = self.client().get(
+                f"/debug/profiles/{summary['id']}", headers=headers).json["profile"]
+            plans.append([query["plan"] for query in profile["queries"]
+                          if "LIKE" in query["statement"]])
+        # newest first
+        self.assertIsNone(plans[0][0])
+        self.assertIsNotNone(plans[1][0])
+
+    def test_locking_statements_not_explained(self):
+        """Test statements locking or writing rows are not run again"""
+        with self.app.app_context():
+            for statement in ("SELECT * FROM questions FOR UPDATE",
+                              "select * from questions for no key update",
+                              "WITH moved AS (UPDATE questions SET category = 2 RETURNING id) "
+                              "SELECT * FROM moved"):
+                self.assertIsNone(explain(db.engine, statement, ()))
+            self.assertTrue(explain(db.engine, "SELECT * FROM questions", ()))
+
+    def test_disabled_without_hooks(self):
+        """Test disabled profiling registers no hook and records nothing"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{self.database_path}",
+            "RESPONSE_CACHE_BACKEND": "none",
+            "RATE_LIMIT_BACKEND": "none",
+            "PROFILING": False,
+        })
+        self.assertNotIn(profiler._start_request, app.before_request_funcs.get(None, []))
+        self.assertNotIn(profiler._finish_request, app.after_request_funcs.get(None, []))
+        recorded = profiler.recorded
+        client = app.test_client()
+        client.post("/questions/search", json={"searchTerm": "title"})
+        # not served without a token
+        self.assertEqual(client.get("/debug/profiles").status_code, 404)
+        profiler.wait()
+        self.assertEqual(profiler.recorded, recorded)
+        with app.app_context():
+            db.engine.dispose()
+
+    @unittest.skipUnless(importlib.util.find_spec("aiosqlite"), "needs pip install aiosqlite")
+    def test_async_handlers_recorded(self):
+        """Test requests of the async handlers are recorded with query plans"""
+        from asgi import create_asgi_app
+        from starlette.testclient import TestClient
+        client = TestClient(create_asgi_app(
+            self.app, f"sqlite+aiosqlite:///{self.database_path}"))
+        client.post("/questions/search", json={"searchTerm": "title"})
+        profiler.wait()
+        headers = {"Authorization": "Bearer secret"}
+        summary = self.client().get("/debug/profiles", headers=headers).json["profiles"][0]
+        self.assertEqual(summary["path"], "/questions/search")
+        profile = self.client().get(
+            f"/debug/profiles/{summary['id']}", headers=headers).json["profile"]
+        self.assertEqual(profile["endpoint"], "search_questions")
+        self.assertTrue(any("LIKE" in query["statement"] and query["plan"]
+                            for query in profile["queries"]))
+
+
+@unittest.skipUnless(importlib.util.find_spec("aiosqlite"), "needs pip install aiosqlite")
+class TestAsgiParity(SQLiteTestCase):
+    """Async handlers against the Flask views, on an SQLite database"""
+
+    def setUp(self):
+        from asgi import create_asgi_app
+        from starlette.testclient import TestClient
+        super().setUp()
+        self.asgi_client = TestClient(create_asgi_app(
+            self.app, f"sqlite+aiosqlite:///{self.database_path}"))
+        with self.app.app_context():
+            db.session.add(Category("Sciençe"))
+            db.session.add(Question("Café or thé?", "It’s café", 1, 1))
+            db.session.commit()
+
+    def test_non_ascii_bodies_identical(self):
+        """Test both servers write the same bytes for non-ASCII text"""
+        for method, path, kwargs in (
+                ("get", "/categories", {}),
+                ("get", "/questions", {}),
+                ("get", "/categories/1/questions", {}),
+                ("post", "/quizzes", {"json": {
+                    "previous_questions": [], "quiz_category": {"id": 1}}})):
+            flask_response = getattr(self.client(), method)(path, **kwargs)
+            asgi_response = getattr(self.asgi_client, method)(path, **kwargs)
+            self.assertEqual(flask_response.status_code, 200)
+            self.assertEqual(flask_response.data, asgi_response.content, path)
+
+    def test_caches_invalidated_while_loading(self):
+        """Test caches dropped by another thread right after the async
+        handlers loaded them are loaded again off the sync loaders"""
+        def invalidated_once(cache):
+            load = cache.load
+
+            def wrapper(rows):
+                loaded = load(rows)
+                if wrapper.calls == 0:
+                    cache.invalidate()
+                wrapper.calls += 1
+                return loaded
+
+            wrapper.calls = 0
+            return mock.patch.object(cache, "load", wrapper)
+
+        with invalidated_once(category_cache):
+            response = self.asgi_client.get("/categories")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["categories"], {"1": "Sciençe"})
+        with invalidated_once(question_index):
+            response = self.asgi_client.post("/quizzes", json={
+                "previous_questions": [], "quiz_category": {"id": 1}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["question"]["id"], 1)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
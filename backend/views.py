@@ -1,5 +1,22 @@
-from flask import Flask, request, abort, jsonify
+import os
+from flask import Flask, Response, current_app, request, abort, jsonify
+from category_cache import category_cache
 from models import Category, Question, db
+import bulk
+import db_pool
+from metrics import metrics
+from profiling import profiler
+import question_counts
+import search
+import serialization
+import streaming
+from question_index import question_index
+from question_store import StoredQuestion, question_store
+from quiz_sessions import quiz_sessions
+from rate_limit import limiter
+from response_cache import response_cache
+from routing import read_only, replicas
+from write_behind import write_behind
 from sqlalchemy.exc import SQLAlchemyError
 from http import HTTPStatus
 from sqlalchemy.sql import func
@@ -8,14 +25,19 @@ from sqlalchemy.orm import load_only
 QUESTIONS_PER_PAGE = 10
 
 # number of questions per play
-QUESTIONS_PER_PLAY = 5
+QUESTIONS_PER_PLAY = int(os.environ.get("QUESTIONS_PER_PLAY", 5))
 
+# difficulty of the first question of an adaptive play
+ADAPTIVE_START_DIFFICULTY = int(os.environ.get("ADAPTIVE_START_DIFFICULTY", 1))
 
+
+@read_only
 def get_categories():
-    """GET /categories - get all categories"""
-    categories = {}
-    {categories.update(item.format()) for item in Category.query.all()}
-    return jsonify({"categories": categories})
+    """GET /categories - get all categories, supports conditional requests"""
+    response = jsonify({"categories": category_cache.all()})
+    response.set_etag(category_cache.etag)
+    response.last_modified = category_cache.last_modified
+    return response.make_conditional(request)
 
 # for testing only
 
@@ -27,33 +49,51 @@ def create_category():
         abort(HTTPStatus.UNPROCESSABLE_ENTITY)
     else:
         try:
-            db.session.add(Category(category_type))
+            category = Category(category_type)
+            db.session.add(category)
             db.session.commit()
+            category_cache.invalidate()
+            response_cache.invalidate("categories")
+            return jsonify({"category": category.format()}), HTTPStatus.CREATED
         except SQLAlchemyError as e:
-            print(e)
+            current_app.logger.exception(e)
             db.session.rollback()
             abort(HTTPStatus.UNPROCESSABLE_ENTITY)
         finally:
             db.session.close()
 
 
+@read_only
 def get_questions():
-    """GET /questions - get paginated questions"""
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    questionsJson = [item.format() for item in Question.query.all()]
-    categories = {}
-    {categories.update(item.format()) for item in Category.query.all()}
-
-    return jsonify(
-        {
-            "questions": questionsJson[start:end],
-            "total_questions": len(questionsJson),
-            "categories": categories,
-            "currentCategory": "unused",
-        }
-    )
+    """GET /questions - get paginated questions
+
+    Only the requested page is loaded (LIMIT/OFFSET). Passing ``after_id``
+    switches to keyset pagination, which stays constant-time on deep pages.
+    """
+    page = max(request.args.get("page", 1, type=int), 1)
+    after_id = request.args.get("after_id", None, type=int)
+    stored = question_store.page(page, QUESTIONS_PER_PAGE, after_id)
+    if stored is not None:
+        questions, total_questions = stored
+    else:
+        query = db.session.query(*streaming.QUESTION_COLUMNS).order_by(Question.id)
+        if after_id is None:
+            query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+        else:
+            query = query.filter(Question.id > after_id)
+        questions = query.limit(QUESTIONS_PER_PAGE).all()
+        total_questions = question_counts.total()
+    body = {
+        "total_questions": total_questions,
+        "categories": category_cache.all(),
+        "currentCategory": "unused",
+    }
+    if after_id is not None:
+        # cursor for the next page, None when this is the last one
+        body["next_after_id"] = (
+            questions[-1].id if len(questions) == QUESTIONS_PER_PAGE else None
+        )
+    return serialization.json_response(body, questions)
 
 
 def create_question():
@@ -61,8 +101,19 @@ def create_question():
     json = request.get_json()
     category_id = int(json["category"])
     # category not exist?
-    if Category.query.get(category_id) == None:
+    if category_cache.get(category_id) is None:
         abort(HTTPStatus.NOT_FOUND)
+    if write_behind.enabled:
+        try:
+            formatted_question = write_behind.submit({
+                "question": json["question"], "answer": json["answer"],
+                "difficulty": json["difficulty"], "category": category_id})
+        except SQLAlchemyError:
+            abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+        except TimeoutError:
+            # may still be committed, the client cannot tell
+            abort(HTTPStatus.SERVICE_UNAVAILABLE)
+        return jsonify({"question": formatted_question}), HTTPStatus.CREATED
     try:
         question = Question(
             question=json["question"],
@@ -71,32 +122,135 @@ def create_question():
             category=category_id,
         )
         db.session.add(question)
+        question_counts.increment(category_id, question.difficulty)
         db.session.commit()
+        question_index.add(question.id, category_id, question.difficulty)
+        response_cache.invalidate("questions", f"category:{category_id}")
         # return the newly created question together with 201
         formatted_question = question.format()
+        question_store.put(StoredQuestion(**formatted_question))
         return jsonify({"question": formatted_question}), HTTPStatus.CREATED
     except SQLAlchemyError as e:
-        print(e)
+        current_app.logger.exception(e)
+        db.session.rollback()
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    finally:
+        db.session.close()
+
+
+def import_questions():
+    """POST /questions/bulk - create questions from an NDJSON or CSV body"""
+    if request.mimetype not in (bulk.CSV, streaming.NDJSON):
+        abort(HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+    try:
+        inserted, category_ids, errors, error_count = bulk.import_questions(
+            request.stream, request.mimetype, category_cache.all())
+        db.session.commit()
+    except (SQLAlchemyError, UnicodeDecodeError) as e:
+        current_app.logger.exception(e)
+        db.session.rollback()
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    finally:
+        db.session.close()
+    if inserted:
+        question_store.catch_up()
+        question_index.invalidate()
+        response_cache.invalidate(
+            "questions", *[f"category:{id}" for id in category_ids])
+    return (
+        jsonify({"inserted": inserted, "errors": errors,
+                 "error_count": error_count}),
+        HTTPStatus.CREATED if inserted else HTTPStatus.UNPROCESSABLE_ENTITY,
+    )
+
+
+def delete_questions():
+    """DELETE /questions - delete the questions of an id list at once"""
+    try:
+        ids = bulk.validate_ids(bulk.body_field(request.json, "ids"))
+    except ValueError:
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    try:
+        rows = bulk.delete_questions(ids)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        current_app.logger.exception(e)
+        db.session.rollback()
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    finally:
+        db.session.close()
+    deleted = [row.id for row in rows]
+    if deleted:
+        question_store.discard(*deleted)
+        question_index.remove(*deleted)
+        serialization.invalidate(*deleted)
+        response_cache.invalidate(
+            "questions", *{f"category:{row.category}" for row in rows})
+    return jsonify({"deleted": deleted})
+
+
+def update_questions():
+    """PATCH /questions - update some columns of several questions at once"""
+    try:
+        changes = bulk.validate_changes(
+            bulk.body_field(request.json, "questions"), category_cache.all())
+    except ValueError:
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    try:
+        updates = bulk.update_questions(changes)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        current_app.logger.exception(e)
         db.session.rollback()
         abort(HTTPStatus.UNPROCESSABLE_ENTITY)
     finally:
         db.session.close()
+    updated = [before["id"] for before, after in updates]
+    moved = [after for before, after in updates if before != after]
+    if moved:
+        question_index.remove(*[after["id"] for after in moved])
+        for after in moved:
+            question_index.add(after["id"], after["category"], after["difficulty"])
+    if updated:
+        question_store.refresh(*updated)
+        serialization.invalidate(*updated)
+        response_cache.invalidate("questions", *{
+            f"category:{row['category']}" for update in updates for row in update})
+    return jsonify({"updated": updated})
+
+
+@read_only
+def export_questions():
+    """GET /questions/export - stream every question as NDJSON"""
+    return streaming.ndjson_response(streaming.question_rows())
 
 
+@read_only
 def get_questions_by_category(category_id):
-    """GET /categories/<category_id>/questions - get questions of provided category"""
-    if Category.query.get(category_id) is None:
+    """GET /categories/<category_id>/questions - get questions of provided category
+
+    Streams the questions as NDJSON when asked to, see streaming.wants_ndjson.
+    """
+    currentCategory = category_cache.get(category_id)
+    if currentCategory is None:
         abort(HTTPStatus.NOT_FOUND)
+    elif streaming.wants_ndjson():
+        return streaming.ndjson_response(
+            streaming.question_rows(Question.category == category_id))
     else:
-        questions = Question.query.filter(Question.category == category_id)
-        json = [item.format() for item in questions]
-        currentCategory = Category.query.get(category_id).type
-        return jsonify(
+        questions = question_store.category(category_id)
+        if questions is not None:
+            total_questions = len(questions)
+        else:
+            questions = db.session.query(*streaming.QUESTION_COLUMNS).filter(
+                Question.category == category_id).order_by(Question.id)
+            total_questions = question_counts.total(category_id)
+        return serialization.json_response(
             {
-                "questions": json,
-                "total_questions": len(json),
+                "total_questions": total_questions,
                 "currentCategory": currentCategory,
-            }
+            },
+            questions,
         )
 
 
@@ -107,41 +261,76 @@ def delete_question(question_id):
         abort(HTTPStatus.NOT_FOUND)
     else:
         try:
+            category_id = question.category
             db.session.delete(question)
+            question_counts.increment(category_id, question.difficulty, -1)
             db.session.commit()
+            question_store.discard(question_id)
+            question_index.remove(question_id)
+            serialization.invalidate(question_id)
+            response_cache.invalidate("questions", f"category:{category_id}")
             return "", HTTPStatus.NO_CONTENT
         except SQLAlchemyError as e:
-            print(e)
+            current_app.logger.exception(e)
             db.session.rollback()
             abort(HTTPStatus.UNPROCESSABLE_ENTITY)
         finally:
             db.session.close()
 
 
+@read_only
 def search_questions():
-    """POST /questions/search - search questions"""
-    searchTerm = request.get_json()["searchTerm"]
-    # filter case insensitive
-    questions = Question.query.filter(
-        Question.question.ilike(f"%{searchTerm}%")).all()
-    formatted_questions = [item.format() for item in questions]
-
-    return jsonify(
+    """POST /questions/search - search questions, paginated and ranked
+
+    Streams every match as NDJSON when asked to, see streaming.wants_ndjson.
+    """
+    json = request.get_json()
+    if streaming.wants_ndjson():
+        condition, order_by = search.search_criteria(json["searchTerm"])
+        return streaming.ndjson_response(
+            streaming.question_rows(condition, order_by=order_by))
+    page = search.page_number(json.get("page", 1))
+    if page is None:
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    questions, total_questions = search.search_questions(
+        json["searchTerm"], page, QUESTIONS_PER_PAGE)
+
+    return serialization.json_response(
         {
-            "questions": formatted_questions,
-            "total_questions": len(formatted_questions),
+            "total_questions": total_questions,
             "currentCategory": "do not know what to return",
-        }
+        },
+        questions,
     )
 
 
+@read_only
 def get_quizzes():
-    """POST /quizzes - get next question of current play"""
+    """POST /quizzes - get next question of current play
+
+    With ``count``, get up to that many distinct questions at once, so a
+    client can fetch the rest of the play in a single request. With
+    ``adaptive``, the question is harder or easier than the last one
+    depending on the answer, see adaptive_difficulty.
+    """
     previous_questions = request.json["previous_questions"]
     category_id = request.json["quiz_category"]["id"]
+    count = request.json.get("count")
+    difficulty = None
+    if "adaptive" in request.json:
+        difficulty = adaptive_difficulty(request.json["adaptive"])
+        # a round picked up front cannot follow the answers
+        if difficulty is None or count is not None:
+            abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    if count is not None:
+        if type(count) is not int or count < 1:
+            abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+        count = min(count, QUESTIONS_PER_PLAY - len(previous_questions))
+        return serialization.json_response(
+            {}, get_random_questions(previous_questions, category_id, count))
     # randomly pick the question based on specified category
     next_question = (
-        get_random_question(previous_questions, category_id)
+        get_random_question(previous_questions, category_id, difficulty)
         if len(previous_questions) < QUESTIONS_PER_PLAY
         else None
     )
@@ -150,25 +339,162 @@ def get_quizzes():
     return jsonify({"question": formatted_question})
 
 
+@read_only
+def create_quiz_session():
+    """POST /quizzes/sessions - start a play, questions are picked up front"""
+    category_id = request.json["quiz_category"]["id"]
+    question_ids = question_index.sample_many(category_id, QUESTIONS_PER_PLAY)
+    token = quiz_sessions.create(question_ids)
+    return (
+        jsonify({"token": token, "total_questions": len(question_ids)}),
+        HTTPStatus.CREATED,
+    )
+
+
+@read_only
+def get_quiz_session_question(token):
+    """POST /quizzes/sessions/<token>/next - get next question of a play"""
+    try:
+        while True:
+            question_id = quiz_sessions.next_question_id(token)
+            if question_id is None:
+                return jsonify({"question": None})
+            question = Question.query.get(question_id)
+            # skip questions deleted since the play started
+            if question is not None:
+                return jsonify({"question": question.format()})
+    except KeyError:
+        abort(HTTPStatus.NOT_FOUND)
+
+
+@read_only
+def get_stats():
+    """GET /stats - get question counts per category and difficulty"""
+    return jsonify(question_counts.stats())
+
+
 def get_configs():
     """GET /configs - get various configurations"""
     return jsonify({"configs": {"questions_per_play": QUESTIONS_PER_PLAY}})
 
 
-def get_random_question(prev_questions, category_id):
-    """Randomize a question. Either for a provided category or all"""
-    # category is "ALL"
-    if category_id == 0:
-        return (
-            Question.query.filter(Question.id.notin_(prev_questions))
-            .order_by(func.random())
-            .first()
-        )
-    # specific category
-    else:
-        return (
-            Question.query.filter(Question.id.notin_(prev_questions))
-            .filter(Question.category == category_id)
-            .order_by(func.random())
-            .first()
-        )
+def get_cache_stats():
+    """GET /ops/cache - get response cache counters"""
+    return jsonify({"cache": response_cache.stats()})
+
+
+def get_pool_stats():
+    """GET /ops/pool - get database connection pool counters"""
+    return jsonify({
+        "pool": db_pool.pool_stats(db.engine),
+        "replicas": [db_pool.pool_stats(engine) for engine in replicas.engines],
+    })
+
+
+def get_limit_stats():
+    """GET /ops/limits - get rate limiting and load shedding counters"""
+    return jsonify({"limits": limiter.stats()})
+
+
+def get_write_stats():
+    """GET /ops/writes - get write-behind counters and latencies"""
+    return jsonify({"writes": write_behind.stats()})
+
+
+def get_store_stats():
+    """GET /ops/store - get question store size and counters"""
+    return jsonify({"store": question_store.stats()})
+
+
+def get_metrics():
+    """GET /metrics - get request metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def get_profiles():
+    """GET /debug/profiles - list the recorded slow requests and queries
+
+    Needs ``Authorization: Bearer <PROFILING_TOKEN>``, not found without a
+    token configured.
+    """
+    authorize_profiles()
+    return jsonify({"profiles": profiler.records()})
+
+
+def get_profile(profile_id):
+    """GET /debug/profiles/<profile_id> - get a recorded profile and the plans
+    of its slow queries"""
+    authorize_profiles()
+    record = profiler.get(profile_id)
+    if record is None:
+        abort(HTTPStatus.NOT_FOUND)
+    return jsonify({"profile": record})
+
+
+def authorize_profiles():
+    """Abort unless the request carries the profiling token"""
+    if not profiler.token:
+        abort(HTTPStatus.NOT_FOUND)
+    if not profiler.authorized(request.headers.get("Authorization")):
+        abort(HTTPStatus.UNAUTHORIZED)
+
+
+def adaptive_difficulty(adaptive):
+    """Difficulty of the next question of an adaptive play, from the
+    ``{"difficulty": ..., "correct": ...}`` of the last question: one level up
+    after a correct answer, one down otherwise. ``{}`` starts a play. Returns
+    None when ``adaptive`` is invalid."""
+    if not isinstance(adaptive, dict):
+        return None
+    if not adaptive:
+        return ADAPTIVE_START_DIFFICULTY
+    difficulty = adaptive.get("difficulty")
+    correct = adaptive.get("correct")
+    # bool is an int, not a difficulty
+    if type(difficulty) is not int or not isinstance(correct, bool):
+        return None
+    return difficulty + 1 if correct else difficulty - 1
+
+
+def get_random_question(prev_questions, category_id, difficulty=None):
+    """Randomize a question. Either for a provided category or all (0), of
+    the difficulty nearest to ``difficulty`` when given"""
+    excluded = set(prev_questions)
+    while True:
+        question_id = question_index.sample(category_id, excluded, difficulty)
+        if question_id is None:
+            return None
+        stored = question_store.get_many([question_id])
+        if stored is not None:
+            question = stored.get(question_id)
+        else:
+            question = Question.query.get(question_id)
+        if question is not None:
+            return question
+        # deleted by another process since the index was loaded
+        question_index.remove(question_id)
+        excluded.add(question_id)
+
+
+def get_random_questions(prev_questions, category_id, count):
+    """Randomize up to ``count`` distinct questions, as column rows, with one
+    sampling pass and one query"""
+    excluded = set(prev_questions)
+    picked = []
+    while len(picked) < count:
+        question_ids = question_index.sample_many(
+            category_id, count - len(picked), excluded)
+        if not question_ids:
+            break
+        rows = question_store.get_many(question_ids)
+        if rows is None:
+            rows = {row.id: row for row in db.session.query(
+                *streaming.QUESTION_COLUMNS).filter(Question.id.in_(question_ids))}
+        for question_id in question_ids:
+            if question_id in rows:
+                picked.append(rows[question_id])
+            else:
+                # deleted by another process since the index was loaded
+                question_index.remove(question_id)
+        excluded.update(question_ids)
+    return picked
@@ -0,0 +1,163 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from models import Question, db
+from question_index import question_index
+from question_store import StoredQuestion, question_store
+import question_counts
+from response_cache import response_cache
+
+
+class WriteBehind:
+    """Group commit of the questions created by ``POST /questions``.
+
+    Requests hand their question to a background thread and wait for it to be
+    committed. The thread inserts every question waiting, up to
+    ``WRITE_BEHIND_MAX_BATCH``, in one transaction, so under load many requests
+    share a commit instead of each paying for one. After taking a question it
+    waits up to ``WRITE_BEHIND_MAX_DELAY`` seconds for others, 0 only groups
+    the questions that arrived during the previous commit. Responses are sent
+    once the question is saved, nothing is lost when the process stops.
+
+    Enabled with ``WRITE_BEHIND``. Requests give up waiting after
+    ``WRITE_BEHIND_TIMEOUT`` seconds.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_batch = 100
+        self.max_delay = 0
+        self.timeout = 30
+        self.app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+        self.flush_time = 0
+        self.max_flush_time = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault(
+            "WRITE_BEHIND", os.environ.get("WRITE_BEHIND", "false").lower() in ("1", "true"))
+        self.max_batch = app.config.setdefault(
+            "WRITE_BEHIND_MAX_BATCH", int(os.environ.get("WRITE_BEHIND_MAX_BATCH", 100)))
+        self.max_delay = app.config.setdefault(
+            "WRITE_BEHIND_MAX_DELAY", float(os.environ.get("WRITE_BEHIND_MAX_DELAY", 0)))
+        self.timeout = app.config.setdefault(
+            "WRITE_BEHIND_TIMEOUT", float(os.environ.get("WRITE_BEHIND_TIMEOUT", 30)))
+        with self._lock:
+            self._reset()
+
+    def submit(self, question):
+        """Queue the columns of a question, block until it is committed and
+        return it formatted. Raises the error of a failed commit, or
+        TimeoutError when it takes longer than ``WRITE_BEHIND_TIMEOUT``."""
+        future = Future()
+        self._start()
+        self._queue.put((time.perf_counter(), question, future))
+        return future.result(timeout=self.timeout)
+
+    def _start(self):
+        # started by the first request, after any fork of the server
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        with self.app.app_context():
+            try:
+                questions = [Question(**question) for _, question, _ in batch]
+                db.session.add_all(questions)
+                db.session.flush()
+                # formatted before the commit expires the instances
+                formatted = [question.format() for question in questions]
+                question_counts.apply(Counter(
+                    question_counts.key(question.category, question.difficulty)
+                    for question in questions))
+                db.session.commit()
+            # any error, the requests must not wait forever
+            except Exception as e:
+                db.session.rollback()
+                if len(batch) == 1:
+                    self.app.logger.exception(e)
+                    with self._lock:
+                        self.failed += 1
+                    batch[0][2].set_exception(e)
+                    return
+                formatted = None
+            finally:
+                db.session.close()
+        if formatted is None:
+            # one by one, so a bad question only fails its own request
+            for item in batch:
+                self._flush([item])
+            return
+        try:
+            question_store.put(*[StoredQuestion(**question) for question in formatted])
+            for question in formatted:
+                question_index.add(question["id"], question["category"], question["difficulty"])
+            response_cache.invalidate(
+                "questions", *{f"category:{question['category']}" for question in formatted})
+        # committed, the requests must get their question whatever fails here
+        except Exception as e:
+            self.app.logger.exception(e)
+        committed = time.perf_counter()
+        with self._lock:
+            self.flushes += 1
+            self.flushed += len(batch)
+            self.flush_time += committed - started
+            self.max_flush_time = max(self.max_flush_time, committed - started)
+            for queued, _, _ in batch:
+                self.wait_time += committed - queued
+                self.max_wait_time = max(self.max_wait_time, committed - queued)
+        for (_, _, future), question in zip(batch, formatted):
+            future.set_result(question)
+
+    def stats(self):
+        """Counters, flush latency (one transaction) and wait latency (queued
+        until committed, what a request waits) in seconds"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "queued": self._queue.qsize(),
+                "flushes": self.flushes,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "avg_batch_size": self.flushed / self.flushes if self.flushes else 0,
+                "flush_seconds_total": self.flush_time,
+                "avg_flush_seconds": self.flush_time / self.flushes if self.flushes else 0,
+                "max_flush_seconds": self.max_flush_time,
+                "wait_seconds_total": self.wait_time,
+                "avg_wait_seconds": self.wait_time / self.flushed if self.flushed else 0,
+                "max_wait_seconds": self.max_wait_time,
+            }
+
+
+write_behind = WriteBehind()
@@ -13,6 +13,8 @@ class QuestionView extends Component {
       totalQuestions: 0,
       categories: {},
       currentCategory: null,
+      // term of the search shown, its results are paginated too
+      searchTerm: null,
     };
   }
 
@@ -30,6 +32,7 @@ class QuestionView extends Component {
           totalQuestions: result.total_questions,
           categories: result.categories,
           currentCategory: result.current_category,
+          searchTerm: null,
         });
         return;
       },
@@ -41,7 +44,11 @@ class QuestionView extends Component {
   };
 
   selectPage(num) {
-    this.setState({ page: num }, () => this.getQuestions());
+    if (this.state.searchTerm !== null) {
+      this.submitSearch(this.state.searchTerm, num);
+    } else {
+      this.setState({ page: num }, () => this.getQuestions());
+    }
   }
 
   createPagination() {
@@ -72,6 +79,7 @@ class QuestionView extends Component {
           questions: result.questions,
           totalQuestions: result.total_questions,
           currentCategory: result.current_category,
+          searchTerm: null,
         });
         return;
       },
@@ -82,13 +90,13 @@ class QuestionView extends Component {
     });
   };
 
-  submitSearch = (searchTerm) => {
+  submitSearch = (searchTerm, page = 1) => {
     $.ajax({
       url: `/questions/search`, //TODO: update request URL
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({ searchTerm: searchTerm }),
+      data: JSON.stringify({ searchTerm: searchTerm, page: page }),
       xhrFields: {
         withCredentials: true,
       },
@@ -98,6 +106,8 @@ class QuestionView extends Component {
           questions: result.questions,
           totalQuestions: result.total_questions,
           currentCategory: result.current_category,
+          searchTerm: searchTerm,
+          page: page,
         });
         return;
       },
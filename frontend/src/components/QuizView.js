@@ -15,6 +15,11 @@ class QuizView extends Component {
       categories: {},
       numCorrect: 0,
       currentQuestion: {},
+      // rest of the round, fetched together with the first question
+      upcomingQuestions: [],
+      // adaptive plays fetch each question after the answer to the last one
+      adaptive: false,
+      lastCorrect: false,
       guess: '',
       forceEnd: false,
       questionsPerPlay: 0
@@ -53,19 +58,56 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    this.setState(
+      { quizCategory: { type, id } },
+      this.state.adaptive ? () => this.getAdaptiveQuestion({}) : this.getRound
+    );
   };
 
   handleChange = (event) => {
     this.setState({ [event.target.name]: event.target.value });
   };
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions];
-    if (this.state.currentQuestion.id) {
-      previousQuestions.push(this.state.currentQuestion.id);
-    }
+  toggleAdaptive = (event) => {
+    this.setState({ adaptive: event.target.checked });
+  };
 
+  // fetch every question of the round in one request
+  getRound = () => {
+    $.ajax({
+      url: '/quizzes', //TODO: update request URL
+      type: 'POST',
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        previous_questions: [],
+        quiz_category: this.state.quizCategory,
+        count: Math.max(this.state.questionsPerPlay, 1),
+      }),
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (result) => {
+        const [first, ...rest] = result.questions;
+        this.setState({
+          showAnswer: false,
+          currentQuestion: first || {},
+          upcomingQuestions: rest,
+          guess: '',
+          forceEnd: first ? false : true,
+        });
+        return;
+      },
+      error: (error) => {
+        alert('Unable to load question. Please try your request again');
+        return;
+      },
+    });
+  };
+
+  // fetch a question harder or easier than the last one, depending on the answer
+  getAdaptiveQuestion = (adaptive, previousQuestions = []) => {
     $.ajax({
       url: '/quizzes', //TODO: update request URL
       type: 'POST',
@@ -74,6 +116,7 @@ class QuizView extends Component {
       data: JSON.stringify({
         previous_questions: previousQuestions,
         quiz_category: this.state.quizCategory,
+        adaptive: adaptive,
       }),
       xhrFields: {
         withCredentials: true,
@@ -83,7 +126,7 @@ class QuizView extends Component {
         this.setState({
           showAnswer: false,
           previousQuestions: previousQuestions,
-          currentQuestion: result.question,
+          currentQuestion: result.question || {},
           guess: '',
           forceEnd: result.question ? false : true,
         });
@@ -96,11 +139,38 @@ class QuizView extends Component {
     });
   };
 
+  getNextQuestion = () => {
+    const previousQuestions = [...this.state.previousQuestions];
+    if (this.state.currentQuestion.id) {
+      previousQuestions.push(this.state.currentQuestion.id);
+    }
+    if (this.state.adaptive) {
+      this.getAdaptiveQuestion(
+        {
+          difficulty: this.state.currentQuestion.difficulty,
+          correct: this.state.lastCorrect,
+        },
+        previousQuestions
+      );
+      return;
+    }
+    const [next, ...rest] = this.state.upcomingQuestions;
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      currentQuestion: next || {},
+      upcomingQuestions: rest,
+      guess: '',
+      forceEnd: next ? false : true,
+    });
+  };
+
   submitGuess = (event) => {
     event.preventDefault();
     let evaluate = this.evaluateAnswer();
     this.setState({
       numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
+      lastCorrect: evaluate,
       showAnswer: true,
     });
   };
@@ -112,6 +182,8 @@ class QuizView extends Component {
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},
+      upcomingQuestions: [],
+      lastCorrect: false,
       guess: '',
       forceEnd: false,
     });
@@ -140,6 +212,14 @@ class QuizView extends Component {
             );
           })}
         </div>
+        <label className='adaptive-option'>
+          <input
+            type='checkbox'
+            checked={this.state.adaptive}
+            onChange={this.toggleAdaptive}
+          />
+          Adaptive difficulty
+        </label>
       </div>
     );
   }
@@ -189,7 +269,7 @@ class QuizView extends Component {
 
   renderPlay() {
     // change: no need to check for questions per play which is defined in the server side
-    // just keep playing until received question is None (forEnd=True)
+    // just keep playing until the fetched round runs out of questions (forceEnd=True)
     return this.state.forceEnd ? (
       this.renderFinalScore()
     ) : this.state.showAnswer ? (